@@ -35,7 +35,25 @@ resource "oci_core_instance" "tak_server" {
 
   metadata = {
     ssh_authorized_keys = var.ssh_public_key
-    user_data           = base64encode(file("${path.module}/user_data.sh"))
+    user_data           = base64gzip(file("${path.module}/user_data.sh"))
+  }
+
+  # The tile server does not fit in user_data; user_data.sh waits for this upload.
+  # Copied under a temporary name so it never sees a partial file
+  connection {
+    type        = "ssh"
+    host        = self.public_ip
+    user        = "ubuntu"
+    private_key = file(pathexpand(var.ssh_private_key_path))
+  }
+
+  provisioner "file" {
+    source      = "${path.module}/../../TAK-support-scripts/cuzk_tile_server.py"
+    destination = "/home/ubuntu/cuzk_tile_server.py.part"
+  }
+
+  provisioner "remote-exec" {
+    inline = ["mv /home/ubuntu/cuzk_tile_server.py.part /home/ubuntu/cuzk_tile_server.py"]
   }
 
   timeouts {
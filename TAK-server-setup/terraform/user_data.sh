@@ -398,132 +398,26 @@ sleep 5
 
 # Install CUZK Tile Server for on-demand Czech map downloads
 echo "Installing CUZK Tile Server..."
-sudo -u opentakserver bash -c "cd /home/opentakserver/OpenTAKServer && source opentakserver_venv/bin/activate && pip install flask mercantile pillow"
-
-# Create the tile server script
-cat > /home/opentakserver/cuzk_tile_server.py << 'TILEEOF'
-#!/usr/bin/env python3
-"""
-CUZK Tile Server Adapter for ATAK
-Translates XYZ tile requests into ArcGIS REST API calls to Czech CUZK services.
-"""
-
-from flask import Flask, Response, abort
-import requests
-import mercantile
-import hashlib
-import time
-from pathlib import Path
-import logging
-
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-app = Flask(__name__)
-
-CUZK_BASE_URL = "https://ags.cuzk.gov.cz/arcgis/rest/services"
-CACHE_DIR = "/home/opentakserver/ots/tile_cache"
-CACHE_ENABLED = True
-TILE_SIZE = 256
-
-AVAILABLE_SERVICES = {
-    'topo': 'ZABAGED_POLOHOPIS',
-    'contours': 'ZABAGED_VRSTEVNICE',
-    'ortophoto': 'ortofoto/ortofoto',
-    'zmvm': 'ZMVM/zmvm',
-}
-
-class TileCache:
-    def __init__(self, cache_dir):
-        self.cache_dir = Path(cache_dir)
-        if CACHE_ENABLED:
-            self.cache_dir.mkdir(parents=True, exist_ok=True)
-
-    def get_cache_path(self, service, z, x, y):
-        tile_id = f"{service}/{z}/{x}/{y}"
-        hash_dir = hashlib.md5(tile_id.encode()).hexdigest()[:2]
-        cache_path = self.cache_dir / service / str(z) / hash_dir
-        cache_path.mkdir(parents=True, exist_ok=True)
-        return cache_path / f"{x}_{y}.png"
-
-    def get(self, service, z, x, y):
-        if not CACHE_ENABLED:
-            return None
-        cache_file = self.get_cache_path(service, z, x, y)
-        if cache_file.exists():
-            age_days = (time.time() - cache_file.stat().st_mtime) / 86400
-            if age_days < 30:
-                return cache_file.read_bytes()
-            else:
-                cache_file.unlink()
-        return None
-
-    def set(self, service, z, x, y, data):
-        if not CACHE_ENABLED or not data:
-            return
-        try:
-            cache_file = self.get_cache_path(service, z, x, y)
-            cache_file.write_bytes(data)
-        except Exception as e:
-            logger.error(f"Failed to cache tile: {e}")
-
-tile_cache = TileCache(CACHE_DIR)
-
-def download_arcgis_tile(service_path, x, y, z):
-    bbox = mercantile.bounds(x, y, z)
-    url = (f"{CUZK_BASE_URL}/{service_path}/MapServer/export?"
-           f"bbox={bbox.west},{bbox.south},{bbox.east},{bbox.north}&"
-           f"bboxSR=4326&imageSR=3857&size={TILE_SIZE},{TILE_SIZE}&"
-           f"format=png&transparent=true&f=image")
-    try:
-        response = requests.get(url, timeout=30, headers={'User-Agent': 'ATAK-CUZK-Tile-Server/1.0'})
-        if response.status_code == 200 and 'image' in response.headers.get('Content-Type', ''):
-            return response.content
-    except Exception as e:
-        logger.error(f"Download failed: {e}")
-    return None
-
-@app.route('/health')
-def health_check():
-    return {'status': 'ok', 'service': 'CUZK Tile Server'}
-
-@app.route('/services')
-def list_services():
-    return {'services': AVAILABLE_SERVICES, 'usage': '/{service}/{z}/{x}/{y}.png'}
-
-@app.route('/<service>/<int:z>/<int:x>/<int:y>.png')
-def get_tile(service, z, x, y):
-    if service not in AVAILABLE_SERVICES:
-        abort(404)
-    if z < 0 or z > 20:
-        abort(400)
-
-    cached_tile = tile_cache.get(service, z, x, y)
-    if cached_tile:
-        return Response(cached_tile, mimetype='image/png')
-
-    tile_data = download_arcgis_tile(AVAILABLE_SERVICES[service], x, y, z)
-    if tile_data:
-        tile_cache.set(service, z, x, y, tile_data)
-        return Response(tile_data, mimetype='image/png')
-    abort(404)
-
-@app.route('/')
-def index():
-    return """<h1>CUZK Tile Server for ATAK</h1>
-    <p>Available services: topo, contours, ortophoto, zmvm</p>
-    <p>Usage: /{service}/{z}/{x}/{y}.png</p>"""
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8088, debug=False)
-TILEEOF
-
-chown opentakserver:opentakserver /home/opentakserver/cuzk_tile_server.py
-chmod +x /home/opentakserver/cuzk_tile_server.py
-
-# Create tile cache directory
-mkdir -p /home/opentakserver/ots/tile_cache
-chown -R opentakserver:opentakserver /home/opentakserver/ots/tile_cache
+sudo -u opentakserver bash -c "cd /home/opentakserver/OpenTAKServer && source opentakserver_venv/bin/activate && pip install flask aiohttp mercantile pillow numpy"
+
+# Install the tile server script
+# The tile server is too big for user_data (OCI caps metadata at 32 KB); Terraform
+# uploads TAK-support-scripts/cuzk_tile_server.py over SSH while this script runs
+TILE_SERVER_UPLOAD=/home/ubuntu/cuzk_tile_server.py
+for i in $(seq 1 60); do
+    [ -s "$TILE_SERVER_UPLOAD" ] && break
+    echo "Waiting for the tile server upload..."
+    sleep 10
+done
+if [ -s "$TILE_SERVER_UPLOAD" ]; then
+    install -m 755 -o opentakserver -g opentakserver "$TILE_SERVER_UPLOAD" /home/opentakserver/cuzk_tile_server.py
+else
+    echo "WARNING: $TILE_SERVER_UPLOAD was not uploaded; copy TAK-support-scripts/cuzk_tile_server.py to /home/opentakserver/ by hand"
+fi
+
+# Create tile cache and offline MBTiles directories
+mkdir -p /home/opentakserver/ots/tile_cache /home/opentakserver/ots/mbtiles
+chown -R opentakserver:opentakserver /home/opentakserver/ots/tile_cache /home/opentakserver/ots/mbtiles
 
 # Create CUZK Tile Server systemd service
 echo "Creating CUZK Tile Server service..."
@@ -35,6 +35,12 @@ variable "ssh_public_key" {
   default     = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDBCJcmALIj4xrnngRIuLD4DMztUKNDhbAVCTKJjBnUddCO0n3UCqk0Xh3xS69P/PcAV+ER2ZTRR0EzAGbbMoUzFO3necSfJ+n3u2UPtKygsIhrmkooj0FvU9lwhcMVjc9IVSOx+OO85XyhZSMgmMCviJKgrJoMwOEdneYpkKDx4f4WptALZmJPjXiTMS/5lRn9rQYcuKYlZe1NFpoBrIHCODo0AXCq3JWozIqL1vn6Mqu98U34mjZ7+SIrMqXrk9qMZ0AjGWx4xJDbEGbRjshahl1mI+BQGSPo01+sBC4kDa2aAfjqHOR7NAN5KNDn0/ABQiwnJ1BGlXBQF8h3ojVL ssh-key-2025-09-10"
 }
 
+variable "ssh_private_key_path" {
+  description = "The path to the private key matching ssh_public_key, used to upload the tile server"
+  type        = string
+  default     = "~/.ssh/id_rsa"
+}
+
 variable "instance_shape" {
   description = "The shape of the compute instance"
   type        = string
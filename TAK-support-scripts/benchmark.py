@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the tile server and the downloaders, run against mock_arcgis_server.py
+
+Tile server: replays seeded ATAK-like pan/zoom traces from concurrent clients
+and reports latency percentiles, requests/s, cache hit ratio and upstream
+requests, once on a cold cache and again on the warm one. Downloaders: tiles/s
+and peak RSS of CzechMapDownloader and CzechElevationDownloader, and the raw
+MBTiles write throughput. With the same arguments, results are comparable
+between runs; --json saves them for regression checks.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+import numpy as np
+import requests
+import mercantile
+from mock_arcgis_server import BASE_PATH
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TILE_SERVER = os.path.join(SCRIPT_DIR, 'cuzk_tile_server.py')
+
+# Where clients start: Prague, Brno, Ostrava, Plzen, or anywhere in the country
+HOTSPOTS = [(14.42, 50.08), (16.61, 49.20), (18.26, 49.83), (13.38, 49.75)]
+HOTSPOT_SHARE = 0.7
+VIEWPORT = (5, 4)  # tiles across and down on a phone screen
+CLIENT_CONNECTIONS = 4  # parallel tile requests per client, as ATAK
+MIN_ZOOM, MAX_ZOOM = 8, 17
+SERVER_START_TIMEOUT = 30
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else 0.0
+
+def peak_rss_mb():
+    """Peak resident memory of this process and of its largest finished child process
+
+    Linux carries ru_maxrss over from the parent through fork and exec, so
+    this process's own peak is read from VmHWM where available.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open('/proc/self/status') as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except (OSError, StopIteration):
+        pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return round(own, 1), round(children, 1)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(url, process, log_path, what):
+    """Poll url until process answers; exit with the end of its log if it does not start"""
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    with open(log_path) as f:
+        sys.exit(f"{what} did not start:\n{f.read()[-2000:]}")
+
+class MockUpstream:
+    """mock_arcgis_server.py in its own process, so it competes with neither the
+    benchmark clients for the GIL nor the measured processes for memory"""
+
+    def __init__(self, latency_ms, jitter_ms, error_rate, seed, work_dir):
+        port = free_port()
+        self.root = f"http://127.0.0.1:{port}"
+        self.base_url = self.root + BASE_PATH
+        log_path = os.path.join(work_dir, 'mock_arcgis_server.log')
+        with open(log_path, 'w') as log:
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.join(SCRIPT_DIR, 'mock_arcgis_server.py'), '--port', str(port),
+                 '--latency-ms', str(latency_ms), '--jitter-ms', str(jitter_ms),
+                 '--error-rate', str(error_rate), '--seed', str(seed)],
+                stdout=log, stderr=subprocess.STDOUT)
+        wait_for(f"{self.root}/stats", self.process, log_path, "Mock ArcGIS server")
+
+    def snapshot(self):
+        return requests.get(f"{self.root}/stats", timeout=10).json()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+def run_isolated(fn, *args):
+    """Run fn in a fresh process, so its peak RSS is its own"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+# Tile server
+
+def client_trace(rng, steps):
+    """Tile requests of one client, grouped per screen update
+
+    The client pans by a tile (60%), zooms in (20%) or zooms out (20%) at
+    each step and only asks for tiles it has not loaded yet, like ATAK with
+    its own tile cache. It uses one base layer, sometimes with the contour
+    overlay on top.
+    """
+    if rng.random() < HOTSPOT_SHARE:
+        lon, lat = rng.choice(HOTSPOTS)
+        lon, lat = lon + rng.gauss(0, 0.05), lat + rng.gauss(0, 0.03)
+    else:
+        lon, lat = rng.uniform(12.5, 18.5), rng.uniform(48.8, 50.9)
+    z = rng.randint(11, 14)
+    tile = mercantile.tile(lon, lat, z)
+    cx, cy = tile.x, tile.y
+    layers = [rng.choice(['topo', 'topo', 'zmvm', 'ortophoto'])]
+    if rng.random() < 0.5:
+        layers.append('contours')
+
+    seen = set()
+    trace = []
+    for _ in range(steps):
+        action = rng.random()
+        if action < 0.6 or not (MIN_ZOOM < z < MAX_ZOOM):
+            dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, -1)])
+            cx, cy = cx + dx, cy + dy
+        elif action < 0.8:
+            z, cx, cy = z + 1, cx * 2 + rng.randint(0, 1), cy * 2 + rng.randint(0, 1)
+        else:
+            z, cx, cy = z - 1, cx // 2, cy // 2
+
+        width, height = VIEWPORT
+        step = []
+        for x in range(cx - width // 2, cx - width // 2 + width):
+            for y in range(cy - height // 2, cy - height // 2 + height):
+                for service in layers:
+                    if 0 <= y < 2 ** z and (service, z, x, y) not in seen:
+                        seen.add((service, z, x, y))
+                        step.append((service, z, x % 2 ** z, y))
+        trace.append(step)
+    return trace
+
+def replay(server_url, traces):
+    """Replay every client's trace concurrently; returns (latencies, statuses, seconds)"""
+    latencies, statuses = [], []
+    lock = threading.Lock()
+
+    def run_client(trace):
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=CLIENT_CONNECTIONS))
+
+        def get(tile):
+            service, z, x, y = tile
+            started = time.monotonic()
+            try:
+                status = session.get(f"{server_url}/{service}/{z}/{x}/{y}.png", timeout=120).status_code
+            except requests.RequestException:
+                status = 0
+            with lock:
+                latencies.append(time.monotonic() - started)
+                statuses.append(status)
+
+        with ThreadPoolExecutor(max_workers=CLIENT_CONNECTIONS) as pool:
+            for step in trace:
+                list(pool.map(get, step))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(traces)) as clients:
+        list(clients.map(run_client, traces))
+    return latencies, statuses, time.monotonic() - started
+
+def tile_request_counts(server_url):
+    """cuzk_tile_requests_total by source, summed over services"""
+    counts = {}
+    text = requests.get(f"{server_url}/metrics", timeout=10).text
+    for source, value in re.findall(r'^cuzk_tile_requests_total\{[^}]*source="(\w+)"[^}]*\} (\S+)$', text, re.M):
+        counts[source] = counts.get(source, 0) + float(value)
+    return counts
+
+def start_tile_server(script, mode, base_url, work_dir, prefetch):
+    """Start the tile server on a free port with an empty cache; returns (process, url)"""
+    port = free_port()
+    env = dict(os.environ,
+               CUZK_BASE_URL=base_url,
+               CUZK_CACHE_DIR=os.path.join(work_dir, 'tile_cache'),
+               CUZK_OFFLINE_DIR=os.path.join(work_dir, 'mbtiles'),
+               CUZK_PORT=str(port),
+               CUZK_SERVER_MODE=mode,
+               CUZK_PREFETCH='1' if prefetch else '0')
+    log_path = os.path.join(work_dir, 'tile_server.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, script], env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    wait_for(f"{url}/health", process, log_path, "Tile server")
+    return process, url
+
+def bench_tile_server(args, mock, work_dir):
+    rng = random.Random(args.seed)
+    traces = [client_trace(rng, args.steps) for _ in range(args.clients)]
+    print(f"Tile server ({args.server_mode}): {args.clients} clients, "
+          f"{sum(len(step) for trace in traces for step in trace)} requests per pass")
+
+    process, url = start_tile_server(args.server_script, args.server_mode, mock.base_url, work_dir, args.prefetch)
+    results = {}
+    try:
+        for name in ['cold', 'warm'][:args.passes]:
+            before_counts, before_upstream = tile_request_counts(url), mock.snapshot()
+            latencies, statuses, seconds = replay(url, traces)
+            time.sleep(0.5)  # let background prefetches settle before counting
+            counts = {source: value - before_counts.get(source, 0)
+                      for source, value in tile_request_counts(url).items()}
+            upstream = {key: value - before_upstream[key] for key, value in mock.snapshot().items()}
+
+            requested = sum(counts.values())
+            hits = sum(counts.get(source, 0) for source in ('memory', 'disk', 'archive'))
+            results[name] = {
+                'requests': len(latencies),
+                'errors': sum(status not in (200, 304) for status in statuses),
+                'seconds': round(seconds, 2),
+                'requests_per_s': round(len(latencies) / seconds, 1),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+                'max_ms': round(max(latencies) * 1000, 1),
+                'sources': {source: int(value) for source, value in sorted(counts.items()) if value},
+                'hit_ratio': round(hits / requested, 3) if requested else 0.0,
+                'upstream_requests': upstream['export'] + upstream['exportImage'],
+                'upstream_errors': upstream['errors'],
+            }
+            result = results[name]
+            print(f"  {name:5} {result['requests_per_s']:8.1f} req/s  p50 {result['p50_ms']:7.1f} ms  "
+                  f"p99 {result['p99_ms']:7.1f} ms  hit ratio {result['hit_ratio']:.1%}  "
+                  f"upstream {result['upstream_requests']}  errors {result['errors']}")
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return results
+
+# Downloaders (each runs in its own process via run_isolated)
+
+def quiet(verbose):
+    return open(os.devnull, 'w') if not verbose else sys.stdout
+
+def bench_map_downloader(base_url, zoom_levels, workers, metatile, out_dir, verbose):
+    from czech_map_downloader import CzechMapDownloader
+    output_file = os.path.join(out_dir, 'topo.mbtiles')
+    with redirect_stdout(quiet(verbose)):
+        downloader = CzechMapDownloader(max_workers=workers, metatile=metatile, base_url=base_url)
+        started = time.monotonic()
+        tiles = downloader.download_topographic_maps(output_file, zoom_levels=zoom_levels)
+        seconds = time.monotonic() - started
+    own, children = peak_rss_mb()
+    return {'tiles': tiles, 'seconds': round(seconds, 2), 'tiles_per_s': round(tiles / seconds, 1),
+            'upstream_requests': downloader.client.stats['requests'],
+            'file_mb': round(os.path.getsize(output_file) / 2 ** 20, 1),
+            'peak_rss_mb': own, 'peak_child_rss_mb': children}
+
+def bench_elevation_downloader(base_url, zoom_levels, workers, pyramid, out_dir, verbose):
+    from czech_elevation_downloader import CzechElevationDownloader
+    output_file = os.path.join(out_dir, 'hillshade.mbtiles')
+    with redirect_stdout(quiet(verbose)):
+        downloader = CzechElevationDownloader(max_workers=workers, base_url=base_url)
+        started = time.monotonic()
+        tiles = downloader.create_hillshade_mbtiles(output_file, zoom_levels=zoom_levels, pyramid=pyramid)
+        seconds = time.monotonic() - started
+    own, children = peak_rss_mb()
+    return {'tiles': tiles, 'seconds': round(seconds, 2), 'tiles_per_s': round(tiles / seconds, 1),
+            'upstream_requests': downloader.client.stats['requests'],
+            'file_mb': round(os.path.getsize(output_file) / 2 ** 20, 1),
+            'peak_rss_mb': own, 'peak_child_rss_mb': children}
+
+def bench_mbtiles_write(tiles, deduplicate, out_dir, seed):
+    """Write synthetic tiles through MBTilesWriter in downloader-sized batches
+
+    A third of the tiles are one shared blank image, as in sparse overlays.
+    """
+    import sqlite3
+    from mbtiles_writer import MBTilesWriter, create_tiles_schema
+    output_file = os.path.join(out_dir, f"write-{'dedup' if deduplicate else 'flat'}.mbtiles")
+    conn = sqlite3.connect(output_file)
+    create_tiles_schema(conn, deduplicate)
+    conn.commit()
+    conn.close()
+
+    rng = np.random.default_rng(seed)
+    images = [rng.bytes(int(size)) for size in rng.integers(8000, 40000, 256)]
+    blank = b'\x89PNG blank tile' + bytes(300)
+    size = int(np.ceil(np.sqrt(tiles)))
+    rows = [(16, i % size, i // size, blank if i % 3 == 0 else images[i % len(images)] + i.to_bytes(4, 'big'))
+            for i in range(tiles)]
+    data_mb = sum(len(row[3]) for row in rows) / 2 ** 20
+
+    started = time.monotonic()
+    writer = MBTilesWriter(output_file)
+    for i in range(0, tiles, 16):
+        writer.write(rows[i:i + 16])
+    writer.close(optimize=False)
+    seconds = time.monotonic() - started
+    return {'tiles': tiles, 'seconds': round(seconds, 2), 'tiles_per_s': round(tiles / seconds, 1),
+            'mb_per_s': round(data_mb / seconds, 1),
+            'file_mb': round(os.path.getsize(output_file) / 2 ** 20, 1)}
+
+def bench_downloaders(args, mock, out_dir):
+    results = {}
+    before = mock.snapshot()
+    results['map'] = run_isolated(bench_map_downloader, mock.base_url, args.map_zooms, args.workers,
+                                  args.metatile, out_dir, args.verbose)
+    result = results['map']
+    print(f"Map downloader: {result['tiles']} tiles, {result['tiles_per_s']} tiles/s, "
+          f"{result['upstream_requests']} requests, peak RSS {result['peak_rss_mb']} MB "
+          f"(children {result['peak_child_rss_mb']} MB)")
+
+    results['elevation'] = run_isolated(bench_elevation_downloader, mock.base_url, args.elevation_zooms,
+                                        args.workers, args.pyramid, out_dir, args.verbose)
+    result = results['elevation']
+    print(f"Elevation downloader: {result['tiles']} tiles, {result['tiles_per_s']} tiles/s, "
+          f"{result['upstream_requests']} requests, peak RSS {result['peak_rss_mb']} MB "
+          f"(render processes {result['peak_child_rss_mb']} MB)")
+    results['upstream_errors'] = mock.snapshot()['errors'] - before['errors']
+
+    for deduplicate in (False, True):
+        name = 'mbtiles_write_dedup' if deduplicate else 'mbtiles_write'
+        results[name] = run_isolated(bench_mbtiles_write, args.write_tiles, deduplicate, out_dir, args.seed)
+        result = results[name]
+        print(f"MBTiles write ({'deduplicated' if deduplicate else 'flat'}): {result['tiles_per_s']} tiles/s, "
+              f"{result['mb_per_s']} MB/s, {result['file_mb']} MB file")
+    return results
+
+def zoom_list(value):
+    return [int(z) for z in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tile server and downloaders against a mock CUZK")
+    parser.add_argument('suite', nargs='?', choices=['all', 'tileserver', 'downloaders'], default='all')
+    parser.add_argument('--latency-ms', type=float, default=60, help="Mock upstream base latency (default: %(default)s)")
+    parser.add_argument('--jitter-ms', type=float, default=40,
+                        help="Mean extra mock latency, exponentially distributed (default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.01, help="Mock 503 rate (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for traces, latencies and errors")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results to FILE")
+    parser.add_argument('--verbose', action='store_true', help="Show the downloaders' output")
+
+    group = parser.add_argument_group('tile server')
+    group.add_argument('--server-script', default=TILE_SERVER,
+                       help="Tile server to benchmark (default: %(default)s)")
+    group.add_argument('--server-mode', choices=['flask', 'async'], default='flask')
+    group.add_argument('--clients', type=int, default=8, help="Concurrent clients (default: %(default)s)")
+    group.add_argument('--steps', type=int, default=30, help="Pan/zoom steps per client (default: %(default)s)")
+    group.add_argument('--passes', type=int, choices=[1, 2], default=2,
+                       help="2 replays the traces on the warm cache (default: %(default)s)")
+    group.add_argument('--no-prefetch', dest='prefetch', action='store_false', help="Run with CUZK_PREFETCH=0")
+
+    group = parser.add_argument_group('downloaders')
+    group.add_argument('--map-zooms', type=zoom_list, default=[6, 8, 10, 11], help="(default: 6,8,10,11)")
+    group.add_argument('--elevation-zooms', type=zoom_list, default=[6, 8, 10], help="(default: 6,8,10)")
+    group.add_argument('--workers', type=int, default=8, help="Download threads (default: %(default)s)")
+    group.add_argument('--metatile', type=int, default=4, help="Map downloader metatile size (default: %(default)s)")
+    group.add_argument('--pyramid', action='store_true', help="Elevation downloader --pyramid mode")
+    group.add_argument('--write-tiles', type=int, default=20000,
+                       help="Tiles for the MBTiles write test (default: %(default)s)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='cuzk-bench-')
+    mock = MockUpstream(args.latency_ms, args.jitter_ms, args.error_rate, args.seed, work_dir)
+    print(f"Mock CUZK at {mock.base_url}: {args.latency_ms:g} ms + ~{args.jitter_ms:g} ms, "
+          f"{args.error_rate:.1%} errors; {os.cpu_count()} CPUs")
+
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ('json', 'verbose')}}
+    try:
+        if args.suite in ('all', 'tileserver'):
+            results['tileserver'] = bench_tile_server(args, mock, work_dir)
+        if args.suite in ('all', 'downloaders'):
+            results['downloaders'] = bench_downloaders(args, mock, work_dir)
+    finally:
+        mock.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Tile coverage of the Czech Republic from its border polygon, shared by the downloaders
+"""
+
+import json
+import math
+import os
+import mercantile
+
+BORDER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'czech_border.geojson')
+DEFAULT_BUFFER_KM = 5.0  # also covers the simplification of the bundled border
+KM_PER_DEGREE = 111.32
+MAX_LATITUDE = 85.0511
+
+def load_polygon(path=BORDER_FILE):
+    """Return the exterior rings [(lon, lat), ...] of every polygon in a GeoJSON file"""
+    with open(path) as f:
+        data = json.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+
+    rings = []
+    for feature in features:
+        geometry = feature.get('geometry', feature)
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        for polygon in polygons:
+            rings.append([(point[0], point[1]) for point in polygon[0]])
+    return rings
+
+class CoverageMask:
+    """Tiles that touch a polygon plus a buffer, computed one tile row at a time
+
+    For a row of tiles, the polygon's extent in longitude within the row's
+    latitude band is the union of each border edge clipped to the band and
+    the inside spans along the band's top and bottom lines. This is exact and
+    costs one pass over the edges per row, instead of a test per tile. The
+    buffer widens each band and span by buffer_km. Results are cached per zoom.
+    """
+
+    def __init__(self, rings=None, buffer_km=DEFAULT_BUFFER_KM):
+        self.rings = rings if rings is not None else load_polygon()
+        self.buffer_km = buffer_km
+        self.edges = []
+        for ring in self.rings:
+            points = ring[:-1] if ring[0] == ring[-1] else ring
+            self.edges.extend(zip(points, points[1:] + points[:1]))
+        lons = [lon for ring in self.rings for lon, _ in ring]
+        lats = [lat for ring in self.rings for _, lat in ring]
+        self.bounds = (min(lons), min(lats), max(lons), max(lats))
+        self.rows = {}
+
+    def lon_spans(self, south, north):
+        """Longitude intervals of the polygon inside the latitude band [south, north]"""
+        spans = []
+        for (x1, y1), (x2, y2) in self.edges:
+            low, high = max(south, min(y1, y2)), min(north, max(y1, y2))
+            if low > high:
+                continue
+            if y1 == y2:
+                spans.append((min(x1, x2), max(x1, x2)))
+                continue
+            xa = x1 + (low - y1) * (x2 - x1) / (y2 - y1)
+            xb = x1 + (high - y1) * (x2 - x1) / (y2 - y1)
+            spans.append((min(xa, xb), max(xa, xb)))
+
+        for lat in (south, north):
+            crossings = sorted(x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+                               for (x1, y1), (x2, y2) in self.edges if (y1 > lat) != (y2 > lat))
+            spans.extend(zip(crossings[0::2], crossings[1::2]))
+        return spans
+
+    def row_ranges(self, zoom):
+        """Return {y: [(min_x, max_x), ...]} of covered tile columns for each tile row"""
+        if zoom in self.rows:
+            return self.rows[zoom]
+
+        n = 2 ** zoom
+        buffer_lat = self.buffer_km / KM_PER_DEGREE
+        west, south, east, north = self.bounds
+        top = mercantile.tile(west, min(MAX_LATITUDE, north + buffer_lat), zoom).y
+        bottom = mercantile.tile(east, max(-MAX_LATITUDE, south - buffer_lat), zoom).y
+
+        rows = {}
+        for y in range(top, bottom + 1):
+            row = mercantile.bounds(0, y, zoom)
+            band_south, band_north = row.south - buffer_lat, row.north + buffer_lat
+            widest = max(abs(band_south), abs(band_north))
+            buffer_lon = self.buffer_km / (KM_PER_DEGREE * max(0.01, math.cos(math.radians(widest))))
+
+            ranges = []
+            for lon_min, lon_max in sorted(self.lon_spans(band_south, band_north)):
+                min_x = max(0, int((lon_min - buffer_lon + 180) / 360 * n))
+                max_x = min(n - 1, int((lon_max + buffer_lon + 180) / 360 * n))
+                if ranges and min_x <= ranges[-1][1] + 1:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], max_x))
+                else:
+                    ranges.append((min_x, max_x))
+            if ranges:
+                rows[y] = ranges
+
+        self.rows[zoom] = rows
+        return rows
+
+    def covers(self, zoom, x, y):
+        return any(min_x <= x <= max_x for min_x, max_x in self.row_ranges(zoom).get(y, ()))
+
+    def tiles(self, zoom):
+        """Yield (x, y) of every covered tile, row by row"""
+        for y, ranges in sorted(self.row_ranges(zoom).items()):
+            for min_x, max_x in ranges:
+                for x in range(min_x, max_x + 1):
+                    yield x, y
+
+    def count(self, zoom):
+        return sum(max_x - min_x + 1
+                   for ranges in self.row_ranges(zoom).values() for min_x, max_x in ranges)
+
+    def tile_bounds(self, zoom):
+        """Bounding tile range of the covered tiles as {'min_x', 'max_x', 'min_y', 'max_y', 'zoom'}"""
+        rows = self.row_ranges(zoom)
+        return {
+            'min_x': min(ranges[0][0] for ranges in rows.values()),
+            'max_x': max(ranges[-1][1] for ranges in rows.values()),
+            'min_y': min(rows),
+            'max_y': max(rows),
+            'zoom': zoom
+        }
+
+def report_tile_counts(mask, zoom_levels):
+    """Print covered and bounding-box tile counts per zoom level; return the covered total"""
+    total = 0
+    box_total = 0
+    for zoom in zoom_levels:
+        bounds = mask.tile_bounds(zoom)
+        covered = mask.count(zoom)
+        box = (bounds['max_x'] - bounds['min_x'] + 1) * (bounds['max_y'] - bounds['min_y'] + 1)
+        total += covered
+        box_total += box
+        print(f"  zoom {zoom:2d}: {covered:>10,} tiles (bounding box: {box:,})")
+    print(f"  total:   {total:>10,} tiles (bounding box: {box_total:,}, "
+          f"border buffer {mask.buffer_km:g} km)")
+    return total
@@ -0,0 +1,1865 @@
+#!/usr/bin/env python3
+"""
+CUZK Tile Server Adapter for ATAK
+Translates XYZ tile requests into ArcGIS REST API calls to Czech CUZK services.
+"""
+
+from flask import Flask, Response, abort, request
+import requests
+from requests.adapters import HTTPAdapter
+import mercantile
+import hashlib
+import time
+import os
+import atexit
+import fcntl
+import sqlite3
+import threading
+import asyncio
+import queue
+import bisect
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager, asynccontextmanager
+from email.utils import formatdate
+from io import BytesIO
+from pathlib import Path
+from PIL import Image, ImageFilter
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+CUZK_BASE_URL = os.environ.get('CUZK_BASE_URL', "https://ags.cuzk.gov.cz/arcgis/rest/services")
+CACHE_DIR = os.environ.get('CUZK_CACHE_DIR', "/home/opentakserver/ots/tile_cache")
+CACHE_ENABLED = True
+CACHE_BACKEND = os.environ.get('CUZK_CACHE_BACKEND', 'files')  # 'files' or 'mbtiles'
+CACHE_MAX_AGE_DAYS = 30  # older tiles are still served, but refreshed in the background
+REFRESH_WORKERS = 2
+HTTP_MAX_AGE = int(os.environ.get('CUZK_HTTP_MAX_AGE', '86400'))  # Cache-Control for fresh tiles
+HTTP_STALE_MAX_AGE = 60  # Cache-Control for expired tiles being refreshed
+MBTILES_BATCH_SIZE = 200
+MBTILES_BATCH_SECONDS = 2.0
+MEMORY_CACHE_BYTES = int(os.environ.get('CUZK_MEMORY_CACHE_MB', '64')) * 1024 * 1024
+TILE_SIZE = 256
+METATILE_SIZE = int(os.environ.get('CUZK_METATILE', '1'))  # fetch NxN blocks per export, 1 = off
+# Blocks must tile every zoom level evenly, and ArcGIS exports at most 4096x4096
+if METATILE_SIZE not in (1, 2, 4, 8, 16):
+    raise SystemExit(f"CUZK_METATILE must be 1, 2, 4, 8 or 16, not {METATILE_SIZE}")
+UPSTREAM_TIMEOUT = 30
+UPSTREAM_CONCURRENCY = int(os.environ.get('CUZK_UPSTREAM_CONCURRENCY', '16'))
+SERVER_MODE = os.environ.get('CUZK_SERVER_MODE', 'flask')  # 'flask' or 'async'
+PORT = int(os.environ.get('CUZK_PORT', '8088'))
+USER_AGENT = 'ATAK-CUZK-Tile-Server/1.0'
+LOCK_STRIPES = 1024
+SQLITE_POOL_SIZE = 8  # idle connections kept per database; more are opened under load
+
+AVAILABLE_SERVICES = {
+    'topo': 'ZABAGED_POLOHOPIS',
+    'contours': 'ZABAGED_VRSTEVNICE',
+    'ortophoto': 'ortofoto/ortofoto',
+    'zmvm': 'ZMVM/zmvm',
+    'hillshade': '3D/dmr5g',  # DMR5G elevation, shaded here (see render_hillshade_block)
+}
+
+# Hillshade is rendered from a block of elevation plus HILLSHADE_BORDER pixels on every
+# side, so gradients and blur continue across tile edges. Same lighting as czech_elevation_downloader.py
+HILLSHADE_AZIMUTH = 315   # degrees, light from the north-west
+HILLSHADE_ALTITUDE = 45   # degrees above the horizon
+HILLSHADE_BORDER = 4
+RENDER_TIMEOUT = 30  # seconds a request waits for its hillshade block to be rendered
+RENDER_WORKERS = int(os.environ.get('CUZK_RENDER_WORKERS', os.cpu_count() or 1))
+
+# Disk cache budget, per service (CUZK_CACHE_MAX_MB_TOPO etc. override the default)
+CACHE_MAX_MB = int(os.environ.get('CUZK_CACHE_MAX_MB', '4096'))  # 0 = unlimited
+CACHE_MAX_BYTES = {service: int(os.environ.get(f"CUZK_CACHE_MAX_MB_{service.upper()}", CACHE_MAX_MB)) * 1024 * 1024
+                   for service in AVAILABLE_SERVICES}
+CACHE_EVICTION = os.environ.get('CUZK_CACHE_EVICTION', 'lru')  # 'lru' or 'lfu'
+CACHE_PIN_ZOOM = int(os.environ.get('CUZK_CACHE_PIN_ZOOM', '10'))  # tiles at or below this zoom are never evicted
+CACHE_PURGE_DAYS = 90  # expired tiles nobody has re-requested for this long are deleted
+JANITOR_INTERVAL = 300
+JANITOR_TARGET = 0.9  # once over budget, evict down to this fraction of it
+JANITOR_BATCH = 1000
+INDEX_FLUSH_SECONDS = 30  # cache writes and hits reach index.db in batches this often
+
+# Pre-built MBTiles (from TAK-support-scripts), checked in order before the cache and CUZK
+OFFLINE_DIR = os.environ.get('CUZK_OFFLINE_DIR', "/home/opentakserver/ots/mbtiles")
+OFFLINE_ARCHIVES = {
+    'topo': [f"{OFFLINE_DIR}/czech_topographic.mbtiles"],
+    'contours': [f"{OFFLINE_DIR}/czech_contours.mbtiles"],
+    'hillshade': [f"{OFFLINE_DIR}/czech_hillshade.mbtiles"],
+}
+OFFLINE_MMAP_BYTES = 256 * 1024 * 1024
+OFFLINE_RECHECK_SECONDS = 10  # how often archives are checked for having been replaced
+
+# Czech Republic bounds (same as the downloaders); tiles outside get a blank PNG without going upstream
+COVERAGE_BOUNDS = (12.09, 48.55, 18.86, 51.06)
+COVERAGE_MARGIN_TILES = 1
+MAX_ZOOM = 20
+DEDUP_MAX_BYTES = 2048  # tiles this small (blank/uniform) are stored once per content
+
+# Background prefetch of the neighbour ring and next-zoom children after a served miss
+PREFETCH_ENABLED = os.environ.get('CUZK_PREFETCH', '1') == '1'
+PREFETCH_WORKERS = 2
+PREFETCH_QUEUE_SIZE = 1000
+PREFETCH_RATE = float(os.environ.get('CUZK_PREFETCH_RATE', '4'))  # upstream fetches/s per service
+PREFETCH_MAX_AREA_TILES = 50000  # largest /prefetch area request accepted
+PREFETCH_AREA_SHARE = 0.5  # part of the queue an area prefetch may fill; the rest stays free for enqueue_around
+
+# /metrics histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Values are per process: with several gunicorn workers each one reports its own,
+    and Prometheus sums them per instance.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.kinds = {}
+        self.values = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[(name, labels)] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            hist['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            hist['sum'] += value
+
+    @contextmanager
+    def in_flight(self, name, labels=()):
+        self.inc(name, labels)
+        try:
+            yield
+        finally:
+            self.inc(name, labels, -1)
+
+    def render(self, extra=()):
+        """Return the exposition text; extra is a list of (name, labels, value) samples."""
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), hist in self.histograms.items():
+                rows = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + (None,), hist['counts']):
+                    cumulative += count
+                    le = '+Inf' if bound is None else f"{bound:g}"
+                    rows.append((f"{name}_bucket", labels + (('le', le),), cumulative))
+                rows.append((f"{name}_sum", labels, round(hist['sum'], 6)))
+                rows.append((f"{name}_count", labels, cumulative))
+        for name, labels, value in extra:
+            samples.setdefault(name, []).append((name, labels, value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.kinds.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            # Sorting ignores le, so histogram buckets keep their numeric order, +Inf last
+            rows = sorted(samples[name], key=lambda row: (tuple(l for l in row[1] if l[0] != 'le'), row[0]))
+            for sample, labels, value in rows:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{sample}{{{label_text}}} {value}" if labels else f"{sample} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('cuzk_tile_requests_total', 'counter', 'Tile requests by service and where the tile came from')
+metrics.describe('cuzk_tile_request_seconds', 'histogram', 'Tile request latency by service and zoom')
+metrics.describe('cuzk_tile_requests_in_flight', 'gauge', 'Tile requests being handled')
+metrics.describe('cuzk_upstream_fetch_seconds', 'histogram', 'CUZK export request latency by service')
+metrics.describe('cuzk_upstream_errors_total', 'counter', 'Failed CUZK export requests by service and reason')
+metrics.describe('cuzk_upstream_in_flight', 'gauge', 'CUZK export requests in progress')
+metrics.describe('cuzk_render_seconds', 'histogram', 'Hillshade rendering time per block')
+metrics.describe('cuzk_cache_tiles', 'gauge', 'Tiles in the disk cache (shared by all workers)')
+metrics.describe('cuzk_cache_bytes', 'gauge', 'Bytes of tile data in the disk cache (shared by all workers)')
+metrics.describe('cuzk_cache_max_bytes', 'gauge', 'Disk cache budget per service, 0 = unlimited')
+metrics.describe('cuzk_cache_evictions_total', 'counter', 'Tiles removed by the cache janitor, by reason (size or expired)')
+metrics.describe('cuzk_memory_cache_tiles', 'gauge', 'Tiles in this worker\'s memory cache')
+metrics.describe('cuzk_memory_cache_bytes', 'gauge', 'Bytes in this worker\'s memory cache')
+metrics.describe('cuzk_memory_cache_evictions_total', 'counter', 'Tiles evicted from this worker\'s memory cache')
+metrics.describe('cuzk_refresh_in_progress', 'gauge', 'Expired tile blocks queued or being refreshed')
+metrics.describe('cuzk_prefetch_queued', 'gauge', 'Tiles waiting in the prefetch queue')
+metrics.describe('cuzk_prefetch_fetched_total', 'counter', 'Tiles fetched from CUZK by the prefetcher')
+metrics.describe('cuzk_prefetch_dropped_total', 'counter', 'Prefetch requests dropped because the queue was full')
+
+class MemoryTileCache:
+    """Bounded in-process LRU of hot tiles, sized in bytes, in front of the disk cache."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return (data, fetched_at) or None; freshness is decided by TileCache."""
+        with self.lock:
+            entry = self.tiles.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def peek(self, key):
+        """Like get, but without counting a hit or miss or refreshing the LRU position."""
+        with self.lock:
+            return self.tiles.get(key)
+
+    def set(self, key, data, fetched_at=None):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.tiles[key] = (data, time.time() if fetched_at is None else fetched_at)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.tiles.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+    def stats(self):
+        with self.lock:
+            return {'tiles': len(self.tiles), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class FileTileStore:
+    """One PNG file per tile under service/z/md5prefix/x_y.png; the mtime is the fetch time.
+
+    Small tiles (blank or uniform areas) are stored once under blobs/ by content hash
+    and hard-linked into place, so a sea of identical empty tiles shares one inode.
+    Linked tiles share one mtime too, so their fetch time is kept in the cache
+    index (get returns None for it), and they take no space of their own.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def get_cache_path(self, service, z, x, y):
+        tile_id = f"{service}/{z}/{x}/{y}"
+        hash_dir = hashlib.md5(tile_id.encode()).hexdigest()[:2]
+        return self.cache_dir / service / str(z) / hash_dir / f"{x}_{y}.png"
+
+    def get(self, service, z, x, y):
+        cache_file = self.get_cache_path(service, z, x, y)
+        try:
+            st = cache_file.stat()
+            return cache_file.read_bytes(), st.st_mtime if st.st_nlink == 1 else None
+        except FileNotFoundError:
+            return None
+
+    def mtime(self, service, z, x, y):
+        """Newest fetch of any tile sharing this tile's blob, for linked tiles not yet indexed."""
+        try:
+            return self.get_cache_path(service, z, x, y).stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def stored_size(self, data):
+        """Bytes a tile adds to the cache; linked tiles share a blob of at most DEDUP_MAX_BYTES"""
+        return 0 if len(data) <= DEDUP_MAX_BYTES else len(data)
+
+    def blob_path(self, data):
+        digest = hashlib.md5(data).hexdigest()
+        return self.cache_dir / 'blobs' / digest[:2] / f"{digest}.png"
+
+    def put(self, service, z, x, y, data):
+        cache_file = self.get_cache_path(service, z, x, y)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Never write through an existing link, it may be a shared blob
+        cache_file.unlink(missing_ok=True)
+        if len(data) > DEDUP_MAX_BYTES:
+            cache_file.write_bytes(data)
+            return
+
+        blob = self.blob_path(data)
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, blob)
+        try:
+            os.link(blob, cache_file)
+            os.utime(blob)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            # The janitor removed the blob between the check and the link
+            cache_file.write_bytes(data)
+
+    def touch(self, service, z, x, y):
+        # For a linked tile this is the newest fetch of any of its siblings
+        os.utime(self.get_cache_path(service, z, x, y))
+
+    def flush(self):
+        pass  # Files are written immediately
+
+    def delete_many(self, service, tiles):
+        for z, x, y in tiles:
+            self.get_cache_path(service, z, x, y).unlink(missing_ok=True)
+
+    def collect_garbage(self):
+        """Remove shared blobs that no tile links to any more."""
+        removed = 0
+        for root, _, files in os.walk(self.cache_dir / 'blobs'):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name.endswith('.png') and os.stat(path).st_nlink == 1:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def scan(self, service):
+        """Yield (z, x, y, size, fetched_at) for every cached tile of a service."""
+        service_dir = self.cache_dir / service
+        for root, _, files in os.walk(service_dir):
+            parts = Path(root).relative_to(service_dir).parts
+            if len(parts) != 2 or not parts[0].isdigit():
+                continue
+            z = int(parts[0])
+            for name in files:
+                if not name.endswith('.png'):
+                    continue
+                try:
+                    x, y = (int(v) for v in name[:-4].split('_'))
+                    st = os.stat(os.path.join(root, name))
+                except (ValueError, FileNotFoundError):
+                    continue
+                # A linked tile's mtime is the newest fetch of any of its siblings
+                yield z, x, y, st.st_size if st.st_nlink == 1 else 0, st.st_mtime
+
+class ConnectionPool:
+    """SQLite connections shared by all threads, each used by one thread at a time.
+
+    Per-thread connections would be opened again for every request thread Flask
+    starts; these are reused, and at most SQLITE_POOL_SIZE are kept open while idle.
+    """
+
+    def __init__(self, connect, size=SQLITE_POOL_SIZE):
+        self.connect = connect
+        self.idle = queue.Queue(maxsize=size)
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            try:
+                if self.closed:
+                    conn.close()
+                else:
+                    self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """Close idle connections now and the others when they are returned."""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class MBTilesTileStore:
+    """One MBTiles database per service (service.mbtiles) with a fetched_at column for expiry.
+
+    Uses the deduplicated MBTiles layout: map rows point at images keyed by content
+    hash, and a tiles view keeps the file readable by ATAK, so identical blank tiles
+    are stored once. Writes are queued and committed in batches by a background
+    thread, or at once by flush() when other workers wait for them; WAL mode lets
+    readers in every worker continue while a batch is written.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # one batch at a time; deletes wait for it
+        self.pending = {}
+        self.flushing = {}
+        self.wakeup = threading.Event()
+        self.pools = {}
+        for service in AVAILABLE_SERVICES:
+            self.init_db(service)
+            self.pools[service] = ConnectionPool(lambda service=service: self.connect(service))
+        threading.Thread(target=self.writer, name='mbtiles-writer', daemon=True).start()
+        atexit.register(self.flush)
+
+    def db_path(self, service):
+        return self.cache_dir / f"{service}.mbtiles"
+
+    def connect(self, service):
+        conn = sqlite3.connect(self.db_path(service), timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def connection(self, service):
+        return self.pools[service].connection()
+
+    def init_db(self, service):
+        conn = self.connect(service)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS map (
+                    zoom_level INTEGER,
+                    tile_column INTEGER,
+                    tile_row INTEGER,
+                    tile_id TEXT,
+                    fetched_at REAL
+                )
+            ''')
+            conn.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (
+                    zoom_level, tile_column, tile_row
+                )
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)')
+
+            # Caches created before deduplication have a plain tiles table
+            kind = conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+            if kind and kind[0] == 'table':
+                self.migrate_flat_tiles(conn)
+            conn.execute('''
+                CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                       map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id
+            ''')
+            if conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] == 0:
+                metadata = [
+                    ('name', f"CUZK {AVAILABLE_SERVICES[service]}"),
+                    ('type', 'overlay' if service == 'contours' else 'baselayer'),
+                    ('version', '1.0'),
+                    ('description', f"Tile server cache of CUZK {AVAILABLE_SERVICES[service]}"),
+                    ('format', 'png'),
+                    ('bounds', '12.09,48.55,18.86,51.06'),
+                ]
+                conn.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)', metadata)
+        conn.close()
+
+    def migrate_flat_tiles(self, conn):
+        logger.info("Migrating tile cache database to deduplicated layout")
+        conn.create_function('md5hex', 1, lambda data: hashlib.md5(data).hexdigest())
+        conn.execute('INSERT OR IGNORE INTO images SELECT md5hex(tile_data), tile_data FROM tiles')
+        conn.execute('''
+            INSERT OR REPLACE INTO map
+            SELECT zoom_level, tile_column, tile_row, md5hex(tile_data), fetched_at FROM tiles
+        ''')
+        conn.execute('DROP TABLE tiles')
+
+    def get(self, service, z, x, y):
+        key = (service, z, x, y)
+        with self.lock:
+            entry = self.pending.get(key) or self.flushing.get(key)
+        if entry:
+            return entry
+        tms_y = (2 ** z - 1) - y
+        with self.connection(service) as conn:
+            return conn.execute('''
+                SELECT images.tile_data, map.fetched_at FROM map JOIN images ON images.tile_id = map.tile_id
+                WHERE map.zoom_level=? AND map.tile_column=? AND map.tile_row=?
+            ''', (z, x, tms_y)).fetchone()
+
+    def stored_size(self, data):
+        return len(data)
+
+    def put(self, service, z, x, y, data):
+        with self.lock:
+            self.pending[(service, z, x, y)] = (data, time.time())
+            if len(self.pending) >= MBTILES_BATCH_SIZE:
+                self.wakeup.set()
+
+    def touch(self, service, z, x, y):
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get((service, z, x, y))
+            if entry:
+                self.pending[(service, z, x, y)] = (entry[0], now)
+                return
+        with self.connection(service) as conn, conn:
+            conn.execute('UPDATE map SET fetched_at=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                         (now, z, x, (2 ** z - 1) - y))
+
+    def delete_many(self, service, tiles):
+        # A batch being written could re-insert the rows after the DELETE
+        with self.flush_lock:
+            with self.lock:
+                for z, x, y in tiles:
+                    self.pending.pop((service, z, x, y), None)
+            with self.connection(service) as conn, conn:
+                conn.executemany('DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                 [(z, x, (2 ** z - 1) - y) for z, x, y in tiles])
+
+    def collect_garbage(self):
+        """Remove images that no map row points at any more."""
+        removed = 0
+        for service in AVAILABLE_SERVICES:
+            with self.connection(service) as conn, conn:
+                removed += conn.execute(
+                    'DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)').rowcount
+        return removed
+
+    def scan(self, service):
+        """Yield (z, x, y, size, fetched_at) for every cached tile of a service."""
+        with self.connection(service) as conn:
+            rows = conn.execute('''
+                SELECT map.zoom_level, map.tile_column, map.tile_row, LENGTH(images.tile_data), map.fetched_at
+                FROM map JOIN images ON images.tile_id = map.tile_id
+            ''')
+            for z, x, tms_y, size, fetched_at in rows:
+                yield z, x, (2 ** z - 1) - tms_y, size, fetched_at
+
+    def flush(self):
+        """Commit all queued tiles, waiting for a batch already being written."""
+        with self.flush_lock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+            by_service = {}
+            for (service, z, x, y), (data, fetched_at) in self.flushing.items():
+                images, rows = by_service.setdefault(service, ({}, []))
+                tile_id = hashlib.md5(data).hexdigest()
+                images[tile_id] = data
+                rows.append((z, x, (2 ** z - 1) - y, tile_id, fetched_at))
+            try:
+                for service, (images, rows) in by_service.items():
+                    with self.connection(service) as conn, conn:
+                        conn.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                                         images.items())
+                        conn.executemany('''
+                            INSERT OR REPLACE INTO map
+                            (zoom_level, tile_column, tile_row, tile_id, fetched_at)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', rows)
+            except Exception as e:
+                logger.error(f"Failed to write tile batch: {e}")
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def writer(self):
+        while True:
+            self.wakeup.wait(MBTILES_BATCH_SECONDS)
+            self.wakeup.clear()
+            if self.pending:
+                self.flush()
+
+class CacheIndex:
+    """Size, fetch time and access statistics of every disk-cached tile, in index.db.
+
+    Cache writes and hits are buffered in memory and flushed in batches, off the
+    request path. Triggers keep per-service totals, so /metrics and the janitor read the
+    cache size without walking the cache, and all gunicorn workers share the same
+    numbers. A cache that predates the index is scanned once, in the background.
+    """
+
+    def __init__(self, path, store):
+        self.path = Path(path)
+        self.pool = ConnectionPool(self.connect)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # a batch being written must not re-add forgotten tiles
+        self.records = {}
+        self.accesses = {}
+        with self.connection() as conn, conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tiles (
+                    service TEXT,
+                    z INTEGER,
+                    x INTEGER,
+                    y INTEGER,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL,
+                    accessed_at REAL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (service, z, x, y)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (service, accessed_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tiles_hits ON tiles (service, hits, accessed_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tiles_fetched ON tiles (service, fetched_at)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS totals (
+                    service TEXT PRIMARY KEY,
+                    tiles INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+            ''')
+            conn.executemany('INSERT OR IGNORE INTO totals (service, tiles, bytes) VALUES (?, 0, 0)',
+                             [(service,) for service in AVAILABLE_SERVICES])
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS tiles_added AFTER INSERT ON tiles BEGIN
+                    UPDATE totals SET tiles = tiles + 1, bytes = bytes + NEW.size
+                    WHERE service = NEW.service;
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS tiles_removed AFTER DELETE ON tiles BEGIN
+                    UPDATE totals SET tiles = tiles - 1, bytes = bytes - OLD.size
+                    WHERE service = OLD.service;
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS tiles_resized AFTER UPDATE OF size ON tiles BEGIN
+                    UPDATE totals SET bytes = bytes - OLD.size + NEW.size
+                    WHERE service = NEW.service;
+                END
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        if not self.scanned():
+            threading.Thread(target=self.scan_existing, args=(store,),
+                             name='cache-index-scan', daemon=True).start()
+        threading.Thread(target=self.flusher, name='cache-index-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def connection(self):
+        return self.pool.connection()
+
+    def record(self, service, z, x, y, size, fetched_at):
+        """Add or update a tile after it was written to the store."""
+        with self.lock:
+            self.records[(service, z, x, y)] = (size, fetched_at)
+
+    def fetched_at(self, service, z, x, y):
+        with self.lock:
+            entry = self.records.get((service, z, x, y))
+        if entry:
+            return entry[1]
+        with self.connection() as conn:
+            row = conn.execute('SELECT fetched_at FROM tiles WHERE service=? AND z=? AND x=? AND y=?',
+                               (service, z, x, y)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, service, tiles):
+        with self.flush_lock:
+            with self.lock:
+                for z, x, y in tiles:
+                    self.records.pop((service, z, x, y), None)
+                    self.accesses.pop((service, z, x, y), None)
+            with self.connection() as conn, conn:
+                conn.executemany('DELETE FROM tiles WHERE service=? AND z=? AND x=? AND y=?',
+                                 [(service, z, x, y) for z, x, y in tiles])
+
+    def hit(self, service, z, x, y):
+        key = (service, z, x, y)
+        now = time.time()
+        with self.lock:
+            entry = self.accesses.get(key)
+            self.accesses[key] = (now, entry[1] + 1 if entry else 1)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, {}
+                accesses, self.accesses = self.accesses, {}
+            if not records and not accesses:
+                return
+            with self.connection() as conn, conn:
+                conn.executemany('''
+                    INSERT INTO tiles (service, z, x, y, size, fetched_at, accessed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (service, z, x, y) DO UPDATE SET
+                        size = excluded.size, fetched_at = excluded.fetched_at
+                ''', [key + (size, fetched_at, fetched_at) for key, (size, fetched_at) in records.items()])
+                conn.executemany('''
+                    UPDATE tiles SET accessed_at = MAX(COALESCE(accessed_at, 0), ?), hits = hits + ?
+                    WHERE service=? AND z=? AND x=? AND y=?
+                ''', [(accessed_at, hits) + key for key, (accessed_at, hits) in accesses.items()])
+
+    def flusher(self):
+        while True:
+            time.sleep(INDEX_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to update cache index: {e}")
+
+    def scanned(self):
+        with self.connection() as conn:
+            return conn.execute("SELECT 1 FROM meta WHERE name='scanned'").fetchone() is not None
+
+    def scan_existing(self, store):
+        """Index a cache that predates the index; one worker at a time, until a scan completes."""
+        fd = os.open(self.path.with_name('.index-scan.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is scanning
+            if self.scanned():
+                return
+            for service in AVAILABLE_SERVICES:
+                try:
+                    batch = []
+                    for z, x, y, size, fetched_at in store.scan(service):
+                        batch.append((service, z, x, y, size, fetched_at, fetched_at))
+                        if len(batch) >= JANITOR_BATCH:
+                            self.insert_scanned(batch)
+                            batch = []
+                    self.insert_scanned(batch)
+                except Exception as e:
+                    logger.error(f"Failed to index {service} cache: {e}")
+                    return  # scanned again on the next start
+            # Recount in one go, in case other workers wrote to an index from an older version
+            with self.connection() as conn, conn:
+                conn.execute('''
+                    UPDATE totals SET
+                        tiles = (SELECT COUNT(*) FROM tiles WHERE tiles.service = totals.service),
+                        bytes = (SELECT COALESCE(SUM(size), 0) FROM tiles WHERE tiles.service = totals.service)
+                ''')
+                # Only now, so a scan cut short by a restart runs again
+                conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('scanned', ?)", (str(time.time()),))
+            logger.info(f"Cache index built: {self.totals()}")
+        finally:
+            os.close(fd)
+
+    def insert_scanned(self, rows):
+        with self.connection() as conn, conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO tiles (service, z, x, y, size, fetched_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    def eviction_candidates(self, service, policy, limit):
+        """Unpinned tiles in eviction order: least recently used, or least frequently for 'lfu'.
+
+        Linked tiles (size 0) free no space when deleted and are left to expire.
+        """
+        order = 'hits, accessed_at' if policy == 'lfu' else 'accessed_at'
+        with self.connection() as conn:
+            return conn.execute(f'''
+                SELECT z, x, y, size FROM tiles WHERE service=? AND z>? AND size>0
+                ORDER BY {order} LIMIT ?
+            ''', (service, CACHE_PIN_ZOOM, limit)).fetchall()
+
+    def expired(self, service, before, limit):
+        """Unpinned tiles fetched before `before` and not requested since then."""
+        with self.connection() as conn:
+            return conn.execute('''
+                SELECT z, x, y FROM tiles WHERE service=? AND fetched_at<? AND accessed_at<? AND z>? LIMIT ?
+            ''', (service, before, before, CACHE_PIN_ZOOM, limit)).fetchall()
+
+    def totals(self):
+        with self.connection() as conn:
+            rows = conn.execute('SELECT service, tiles, bytes FROM totals').fetchall()
+        return {service: {'tiles': tiles, 'bytes': size} for service, tiles, size in rows}
+
+class TileCache:
+    def __init__(self, cache_dir, backend=CACHE_BACKEND, memory_bytes=MEMORY_CACHE_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.memory = MemoryTileCache(memory_bytes) if memory_bytes > 0 else None
+        self.store = None
+        self.index = None
+        if CACHE_ENABLED:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            if backend == 'mbtiles':
+                self.store = MBTilesTileStore(self.cache_dir)
+            else:
+                self.store = FileTileStore(self.cache_dir)
+            self.index = CacheIndex(self.cache_dir / 'index.db', self.store)
+
+    def is_fresh(self, fetched_at):
+        return time.time() - fetched_at < CACHE_MAX_AGE_DAYS * 86400
+
+    def lookup(self, service, z, x, y, memory=True, disk=True, record_access=True):
+        """Return (data, fetched_at, tier) for a cached tile, including expired ones, or None.
+
+        Expired tiles are kept so they can be served while a refresh runs. The tier
+        is 'memory' or 'disk'. Internal existence checks pass record_access=False so
+        that they neither count as use for eviction nor promote the tile into memory.
+        """
+        if not CACHE_ENABLED:
+            return None
+        key = (service, z, x, y)
+        if memory and self.memory:
+            entry = self.memory.get(key) if record_access else self.memory.peek(key)
+            if entry:
+                if record_access:
+                    self.index.hit(service, z, x, y)
+                return entry[0], entry[1], 'memory'
+        if not disk:
+            return None
+
+        entry = self.store.get(service, z, x, y)
+        if entry is None:
+            return None
+        tile_data, fetched_at = entry
+        if fetched_at is None:
+            fetched_at = self.index.fetched_at(service, z, x, y)
+        if fetched_at is None:
+            # Linked by another worker and not indexed here yet
+            fetched_at = self.store.mtime(service, z, x, y)
+        if record_access:
+            self.index.hit(service, z, x, y)
+            if self.memory:
+                self.memory.set(key, tile_data, fetched_at)
+        return tile_data, fetched_at, 'disk'
+
+    def get(self, service, z, x, y, record_access=True):
+        """Return the tile data only if it is still fresh."""
+        entry = self.lookup(service, z, x, y, record_access=record_access)
+        if entry and self.is_fresh(entry[1]):
+            return entry[0]
+        return None
+
+    def set(self, service, z, x, y, data):
+        if not CACHE_ENABLED or not data:
+            return
+        try:
+            self.store.put(service, z, x, y, data)
+            self.index.record(service, z, x, y, self.store.stored_size(data), time.time())
+        except Exception as e:
+            logger.error(f"Failed to cache tile: {e}")
+        if self.memory:
+            self.memory.set((service, z, x, y), data)
+
+    def revalidate(self, service, z, x, y, data):
+        """Store a re-fetched tile, rewriting the cached copy only if the content changed."""
+        entry = self.lookup(service, z, x, y, record_access=False)
+        if not entry or entry[0] != data:
+            self.set(service, z, x, y, data)
+            return
+        try:
+            self.store.touch(service, z, x, y)
+            self.index.record(service, z, x, y, self.store.stored_size(data), time.time())
+        except Exception as e:
+            logger.error(f"Failed to refresh tile timestamp: {e}")
+        if self.memory:
+            self.memory.set((service, z, x, y), data)
+
+    def commit(self):
+        """Make stored tiles visible to other workers before their tile lock is released."""
+        if CACHE_ENABLED:
+            self.store.flush()
+
+    def evict(self, service, tiles):
+        """Remove (z, x, y) tiles of one service from every tier."""
+        self.store.delete_many(service, tiles)
+        self.index.forget(service, tiles)
+        if self.memory:
+            for z, x, y in tiles:
+                self.memory.discard((service, z, x, y))
+
+tile_cache = TileCache(CACHE_DIR)
+
+class CacheJanitor:
+    """Keeps each service's disk cache under its CACHE_MAX_BYTES budget, off the request path.
+
+    Every JANITOR_INTERVAL seconds one worker (whoever holds .janitor.lock) deletes
+    tiles that expired more than CACHE_PURGE_DAYS ago and nobody re-requested, then,
+    for services over budget, evicts least recently (lru) or least frequently (lfu)
+    used tiles from the access index down to JANITOR_TARGET of the budget. Tiles at
+    or below CACHE_PIN_ZOOM are pinned and never removed.
+    """
+
+    def __init__(self, cache, interval=JANITOR_INTERVAL):
+        self.cache = cache
+        self.lock_path = cache.cache_dir / '.janitor.lock'
+        threading.Thread(target=self.run, args=(interval,), name='cache-janitor', daemon=True).start()
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Cache janitor failed: {e}")
+
+    def sweep(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is sweeping
+            index = self.cache.index
+            index.flush()
+            removed = 0
+            purge_before = time.time() - CACHE_PURGE_DAYS * 86400
+            for service in AVAILABLE_SERVICES:
+                while True:
+                    tiles = index.expired(service, purge_before, JANITOR_BATCH)
+                    if not tiles:
+                        break
+                    removed += self.evict(service, tiles, 'expired')
+                removed += self.enforce_budget(service)
+            if removed:
+                self.cache.store.collect_garbage()
+        finally:
+            os.close(fd)
+
+    def enforce_budget(self, service):
+        budget = CACHE_MAX_BYTES[service]
+        size = self.cache.index.totals()[service]['bytes']
+        if not budget or size <= budget:
+            return 0
+        target = budget * JANITOR_TARGET
+        removed = 0
+        while size > target:
+            candidates = self.cache.index.eviction_candidates(service, CACHE_EVICTION, JANITOR_BATCH)
+            if not candidates:
+                logger.warning(f"{service} cache is over budget with only pinned or linked tiles left")
+                break
+            tiles = []
+            for z, x, y, tile_size in candidates:
+                tiles.append((z, x, y))
+                size -= tile_size
+                if size <= target:
+                    break
+            removed += self.evict(service, tiles, 'size')
+        if removed:
+            logger.info(f"Evicted {removed} {service} tiles to stay within {budget // (1024 * 1024)} MB")
+        return removed
+
+    def evict(self, service, tiles, reason):
+        self.cache.evict(service, tiles)
+        metrics.inc('cuzk_cache_evictions_total', (('service', service), ('reason', reason)), len(tiles))
+        return len(tiles)
+
+janitor = CacheJanitor(tile_cache) if CACHE_ENABLED else None
+
+class CoverageIndex:
+    """Precomputed per-zoom tile ranges of the area CUZK has data for."""
+
+    def __init__(self, bounds, max_zoom=MAX_ZOOM, margin=COVERAGE_MARGIN_TILES):
+        west, south, east, north = bounds
+        self.ranges = {}
+        for z in range(max_zoom + 1):
+            ul_tile = mercantile.tile(west, north, z)
+            lr_tile = mercantile.tile(east, south, z)
+            self.ranges[z] = (ul_tile.x - margin, lr_tile.x + margin,
+                              ul_tile.y - margin, lr_tile.y + margin)
+
+    def covers(self, z, x, y):
+        min_x, max_x, min_y, max_y = self.ranges[z]
+        return min_x <= x <= max_x and min_y <= y <= max_y
+
+    def clip(self, z, min_x, max_x, min_y, max_y):
+        """Part of a tile range at zoom z inside coverage, as (min_x, max_x, min_y, max_y), or None."""
+        cover_min_x, cover_max_x, cover_min_y, cover_max_y = self.ranges[z]
+        min_x, max_x = max(min_x, cover_min_x, 0), min(max_x, cover_max_x, 2 ** z - 1)
+        min_y, max_y = max(min_y, cover_min_y, 0), min(max_y, cover_max_y, 2 ** z - 1)
+        if min_x > max_x or min_y > max_y:
+            return None
+        return min_x, max_x, min_y, max_y
+
+coverage = CoverageIndex(COVERAGE_BOUNDS)
+
+def make_blank_tile():
+    output = BytesIO()
+    Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+# One shared transparent tile for everything outside coverage
+BLANK_TILE = make_blank_tile()
+SERVER_STARTED_AT = time.time()
+
+class MBTilesArchive:
+    """Read-only, memory-mapped view of a pre-built MBTiles file.
+
+    A file replaced in place (new inode or mtime) is noticed within
+    OFFLINE_RECHECK_SECONDS, and the connections to the old file are then closed.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool(self.connect)
+        self.hits = 0
+        stat = self.path.stat()
+        self.identity = (stat.st_ino, stat.st_mtime)
+        self.mtime = stat.st_mtime
+        self.checked_at = time.monotonic()
+
+    def check_replaced(self):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked_at < OFFLINE_RECHECK_SECONDS:
+                return
+            self.checked_at = now
+            try:
+                stat = self.path.stat()
+            except OSError:
+                return  # Mid-replacement or removed; keep serving the open file
+            identity = (stat.st_ino, stat.st_mtime)
+            if identity != self.identity:
+                logger.info(f"Offline archive {self.path} changed, reopening")
+                self.identity = identity
+                self.mtime = stat.st_mtime
+                self.pool.close()
+                self.pool = ConnectionPool(self.connect)
+
+    def connect(self):
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={OFFLINE_MMAP_BYTES}")
+        return conn
+
+    def connection(self):
+        self.check_replaced()
+        return self.pool.connection()
+
+    def get(self, z, x, y):
+        with self.connection() as conn:
+            row = conn.execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                (z, x, (2 ** z - 1) - y)).fetchone()
+        if row:
+            with self.lock:
+                self.hits += 1
+            return row[0]
+        return None
+
+class OfflineArchives:
+    """Ordered per-service MBTiles archives served with no network I/O."""
+
+    def __init__(self, config):
+        self.archives = {}
+        for service, paths in config.items():
+            for path in paths:
+                try:
+                    archive = MBTilesArchive(path)
+                except OSError:
+                    logger.info(f"Offline archive {path} not found, skipping")
+                    continue
+                self.archives.setdefault(service, []).append(archive)
+                logger.info(f"Serving {service} tiles from {path}")
+
+    def get(self, service, z, x, y):
+        """Return (data, archive mtime) from the first archive that has the tile, or None."""
+        for archive in self.archives.get(service, ()):
+            try:
+                tile_data = archive.get(z, x, y)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to read {archive.path}: {e}")
+                continue
+            if tile_data:
+                return tile_data, archive.mtime
+        return None
+
+    def stats(self):
+        return {service: {str(a.path): a.hits for a in archives}
+                for service, archives in self.archives.items()}
+
+offline_archives = OfflineArchives(OFFLINE_ARCHIVES)
+
+class SingleFlight:
+    """Coalesce concurrent cache misses for the same tile into one upstream fetch.
+
+    Threads in this process wait on the first caller's result. Other processes
+    (gunicorn workers) are serialized through striped file locks next to the
+    cache, so they block until the leader has stored the tile and then read it
+    from disk instead of fetching it again. do_async() does the same for
+    coroutines in async mode.
+    """
+
+    def __init__(self, lock_dir, stripes=LOCK_STRIPES):
+        self.lock_dir = Path(lock_dir)
+        self.stripes = stripes
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.async_calls = {}
+        if CACHE_ENABLED:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+
+    def open_lock(self, key):
+        stripe = int(hashlib.md5(key.encode()).hexdigest()[:8], 16) % self.stripes
+        return os.open(self.lock_dir / f"{stripe:04d}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+
+    def try_lock(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @contextmanager
+    def file_lock(self, key):
+        if not CACHE_ENABLED:
+            yield
+            return
+        fd = self.open_lock(key)
+        try:
+            deadline = time.monotonic() + UPSTREAM_TIMEOUT
+            while not self.try_lock(fd):
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Timed out waiting for tile lock {key}, fetching anyway")
+                    break
+                time.sleep(0.05)
+            yield
+        finally:
+            os.close(fd)
+
+    @asynccontextmanager
+    async def async_file_lock(self, key):
+        if not CACHE_ENABLED:
+            yield
+            return
+        fd = self.open_lock(key)
+        try:
+            deadline = time.monotonic() + UPSTREAM_TIMEOUT
+            while not self.try_lock(fd):
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Timed out waiting for tile lock {key}, fetching anyway")
+                    break
+                await asyncio.sleep(0.05)
+            yield
+        finally:
+            os.close(fd)
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None}
+                self.calls[key] = call
+
+        if not leader:
+            call['event'].wait(UPSTREAM_TIMEOUT * 2)
+            return call['result']
+
+        try:
+            with self.file_lock(key):
+                call['result'] = fn()
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['event'].set()
+        return call['result']
+
+    async def do_async(self, key, fn):
+        future = self.async_calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.async_calls[key] = future
+        result = None
+        try:
+            async with self.async_file_lock(key):
+                result = await fn()
+        finally:
+            del self.async_calls[key]
+            future.set_result(result)
+        return result
+
+single_flight = SingleFlight(Path(CACHE_DIR) / '.locks')
+
+# Shared keep-alive connection pool so cache misses reuse TLS sessions to CUZK
+upstream_session = requests.Session()
+upstream_session.headers.update({'User-Agent': USER_AGENT})
+upstream_adapter = HTTPAdapter(pool_connections=len(AVAILABLE_SERVICES), pool_maxsize=UPSTREAM_CONCURRENCY)
+upstream_session.mount('https://', upstream_adapter)
+upstream_session.mount('http://', upstream_adapter)  # a local CUZK_BASE_URL, e.g. mock_arcgis_server.py
+upstream_slots = threading.BoundedSemaphore(UPSTREAM_CONCURRENCY)
+
+def arcgis_export_url(service_path, x, y, z):
+    bbox = mercantile.bounds(x, y, z)
+    return (f"{CUZK_BASE_URL}/{service_path}/MapServer/export?"
+            f"bbox={bbox.west},{bbox.south},{bbox.east},{bbox.north}&"
+            f"bboxSR=4326&imageSR=3857&size={TILE_SIZE},{TILE_SIZE}&"
+            f"format=png&transparent=true&f=image")
+
+def metatile_origin(z, x, y):
+    """Top-left tile and edge length of the metatile block that contains z/x/y."""
+    n = min(METATILE_SIZE, 2 ** z)
+    return x - x % n, y - y % n, n
+
+def arcgis_metatile_url(service_path, mx, my, z, n):
+    west, _, _, north = mercantile.xy_bounds(mx, my, z)
+    _, south, east, _ = mercantile.xy_bounds(mx + n - 1, my + n - 1, z)
+    size = TILE_SIZE * n
+    return (f"{CUZK_BASE_URL}/{service_path}/MapServer/export?"
+            f"bbox={west},{south},{east},{north}&"
+            f"bboxSR=3857&imageSR=3857&size={size},{size}&"
+            f"format=png&transparent=true&f=image")
+
+def slice_metatile(data, mx, my, n):
+    """Cut an n x n metatile image into {(x, y): png_bytes}."""
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+    except Exception as e:
+        logger.error(f"Invalid metatile image: {e}")
+        return {}
+    if img.size != (TILE_SIZE * n, TILE_SIZE * n):
+        logger.error(f"Unexpected metatile size {img.size}")
+        return {}
+
+    tiles = {}
+    for dx in range(n):
+        for dy in range(n):
+            box = (dx * TILE_SIZE, dy * TILE_SIZE, (dx + 1) * TILE_SIZE, (dy + 1) * TILE_SIZE)
+            output = BytesIO()
+            img.crop(box).save(output, format='PNG')
+            tiles[(mx + dx, my + dy)] = output.getvalue()
+    return tiles
+
+def elevation_export_url(mx, my, z, n, border=HILLSHADE_BORDER):
+    """exportImage URL for float32 elevation of an n x n tile block plus `border` pixels around it."""
+    west, _, _, north = mercantile.xy_bounds(mx, my, z)
+    _, south, east, _ = mercantile.xy_bounds(mx + n - 1, my + n - 1, z)
+    pad = (east - west) / (TILE_SIZE * n) * border
+    size = TILE_SIZE * n + 2 * border
+    return (f"{CUZK_BASE_URL}/{AVAILABLE_SERVICES['hillshade']}/ImageServer/exportImage?"
+            f"bbox={west - pad},{south - pad},{east + pad},{north + pad}&"
+            f"bboxSR=3857&imageSR=3857&size={size},{size}&"
+            f"format=tiff&pixelType=F32&noData=0&"
+            f"interpolation=RSP_BilinearInterpolation&f=image")
+
+def decode_elevation(data):
+    """Decode a float32 TIFF from exportImage; no-data pixels (0) become NaN. None if invalid."""
+    try:
+        img = Image.open(BytesIO(data))
+        img.load()
+        elevation = np.array(img, dtype=np.float32)
+    except Exception as e:
+        logger.error(f"Invalid elevation image: {e}")
+        return None
+    elevation[elevation == 0] = np.nan
+    return elevation
+
+def shade(elevation, azimuth=HILLSHADE_AZIMUTH, altitude=HILLSHADE_ALTITUDE):
+    """0-255 hillshade of a gap-free float32 elevation array.
+
+    Same model as TAK-support-scripts/hillshade.py: slope and aspect from pixel gradients
+    clipped to +-100, shaded as sin(alt) sin(slope) + cos(alt) cos(slope) cos(az - aspect).
+    """
+    azimuth_rad = np.radians(azimuth)
+    altitude_rad = np.radians(altitude)
+
+    dy, dx = np.gradient(elevation)
+    np.clip(dx, -100, 100, out=dx)
+    np.clip(dy, -100, 100, out=dy)
+
+    # |gradient| = tan(slope), so cos(slope) = 1 / sqrt(1 + g^2) and sin(slope) = g cos(slope)
+    g = np.hypot(dx, dy)
+    cos_slope = np.multiply(g, g)
+    cos_slope += 1
+    np.sqrt(cos_slope, out=cos_slope)
+    np.reciprocal(cos_slope, out=cos_slope)
+
+    # aspect = arctan2(-dx, dy), so cos(az - aspect) = (cos(az) dy - sin(az) dx) / g,
+    # and cos(az) where the ground is flat (g = 0)
+    dy *= np.float32(np.cos(azimuth_rad))
+    dx *= np.float32(np.sin(azimuth_rad))
+    dy -= dx
+    flat = g == 0
+    np.divide(dy, g, out=dy, where=~flat)
+    dy[flat] = np.cos(azimuth_rad)
+
+    g *= np.float32(np.sin(altitude_rad))
+    dy *= np.float32(np.cos(altitude_rad))
+    g += dy
+    g *= cos_slope
+
+    g *= 255
+    np.clip(g, 0, 255, out=g)
+    return g.astype(np.uint8)
+
+def render_hillshade_block(data, mx, my, n, border=HILLSHADE_BORDER):
+    """Shade a bordered elevation block and cut it into {(x, y): png_bytes}.
+
+    Runs in render_pool. Tiles with almost no elevation data get the blank tile.
+    """
+    started = time.monotonic()
+    elevation = decode_elevation(data)
+    size = TILE_SIZE * n + 2 * border
+    if elevation is None or elevation.shape != (size, size):
+        logger.error(f"Unexpected elevation block {None if elevation is None else elevation.shape}")
+        return {}
+
+    valid = np.isfinite(elevation)
+    if not valid.any():
+        return {(mx + dx, my + dy): BLANK_TILE for dx in range(n) for dy in range(n)}
+    # Fill no-data with the mean for the gradient calculation
+    if not valid.all():
+        elevation[~valid] = elevation[valid].mean()
+
+    img = Image.fromarray(shade(elevation), mode='L').filter(ImageFilter.GaussianBlur(radius=0.5))
+
+    tiles = {}
+    for dx in range(n):
+        for dy in range(n):
+            left, top = border + dx * TILE_SIZE, border + dy * TILE_SIZE
+            if np.count_nonzero(valid[top:top + TILE_SIZE, left:left + TILE_SIZE]) < 10:
+                tiles[(mx + dx, my + dy)] = BLANK_TILE
+                continue
+            output = BytesIO()
+            img.crop((left, top, left + TILE_SIZE, top + TILE_SIZE)).save(output, format='PNG')
+            tiles[(mx + dx, my + dy)] = output.getvalue()
+    metrics.observe('cuzk_render_seconds', (), time.monotonic() - started)
+    return tiles
+
+# numpy and Pillow release the GIL while rendering, so threads keep CPU work off the
+# request threads and the event loop without forking the server
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='hillshade-render')
+
+def fetch_upstream(service, url):
+    labels = (('service', service),)
+    with upstream_slots, metrics.in_flight('cuzk_upstream_in_flight'):
+        started = time.monotonic()
+        try:
+            response = upstream_session.get(url, timeout=UPSTREAM_TIMEOUT)
+            metrics.observe('cuzk_upstream_fetch_seconds', labels, time.monotonic() - started)
+            if response.status_code == 200 and 'image' in response.headers.get('Content-Type', ''):
+                return response.content
+            reason = f"http_{response.status_code}" if response.status_code != 200 else 'not_image'
+        except requests.Timeout as e:
+            logger.error(f"Download failed: {e}")
+            reason = 'timeout'
+        except Exception as e:
+            logger.error(f"Download failed: {e}")
+            reason = 'connection'
+    metrics.inc('cuzk_upstream_errors_total', labels + (('reason', reason),))
+    return None
+
+def download_arcgis_tile(service, x, y, z):
+    return fetch_upstream(service, arcgis_export_url(AVAILABLE_SERVICES[service], x, y, z))
+
+def download_arcgis_metatile(service, mx, my, z, n):
+    data = fetch_upstream(service, arcgis_metatile_url(AVAILABLE_SERVICES[service], mx, my, z, n))
+    return slice_metatile(data, mx, my, n) if data else {}
+
+def download_hillshade_block(mx, my, z, n):
+    data = fetch_upstream('hillshade', elevation_export_url(mx, my, z, n))
+    if not data:
+        return {}
+    try:
+        return render_pool.submit(render_hillshade_block, data, mx, my, n).result(timeout=RENDER_TIMEOUT)
+    except FuturesTimeoutError:
+        logger.error(f"Rendering hillshade block {z}/{mx}/{my} took over {RENDER_TIMEOUT}s")
+        return {}
+
+def download_block(service, z, x, y):
+    """Download z/x/y, or its whole metatile block, as {(x, y): tile_bytes}."""
+    mx, my, n = metatile_origin(z, x, y)
+    if service == 'hillshade':
+        return download_hillshade_block(mx, my, z, n)
+    if n == 1:
+        tile_data = download_arcgis_tile(service, x, y, z)
+        return {(x, y): tile_data} if tile_data else {}
+    return download_arcgis_metatile(service, mx, my, z, n)
+
+def store_tiles(service, z, tiles):
+    for (x, y), tile_data in tiles.items():
+        tile_cache.set(service, z, x, y, tile_data)
+    tile_cache.commit()
+
+def load_tiles(service, z, x, y):
+    """Fetch a missing tile, or its whole metatile, from CUZK and cache it.
+
+    Runs once per metatile block via single_flight and returns {(x, y): tile_bytes}.
+    """
+    # Another worker may have stored the tile while we waited for the lock
+    cached_tile = tile_cache.get(service, z, x, y, record_access=False)
+    if cached_tile:
+        return {(x, y): cached_tile}
+
+    tiles = download_block(service, z, x, y)
+    store_tiles(service, z, tiles)
+    return tiles
+
+# Expired tiles are served immediately and refreshed here, off the request path
+refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix='tile-refresh')
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+def refresh_tiles(service, z, x, y, block_key):
+    try:
+        with single_flight.file_lock(block_key):
+            # Another worker may already have refreshed this block
+            if tile_cache.get(service, z, x, y, record_access=False):
+                return
+            for (tx, ty), tile_data in download_block(service, z, x, y).items():
+                tile_cache.revalidate(service, z, tx, ty, tile_data)
+            tile_cache.commit()
+    except Exception as e:
+        logger.error(f"Background refresh of {block_key} failed: {e}")
+    finally:
+        with refreshing_lock:
+            refreshing.discard(block_key)
+
+def schedule_refresh(service, z, x, y):
+    mx, my, _ = metatile_origin(z, x, y)
+    block_key = f"{service}/{z}/{mx}/{my}"
+    with refreshing_lock:
+        if block_key in refreshing:
+            return
+        refreshing.add(block_key)
+    refresh_pool.submit(refresh_tiles, service, z, x, y, block_key)
+
+def tile_headers(tile_data, fetched_at, fresh):
+    """HTTP caching headers for a tile: content-hash ETag, Last-Modified and max-age."""
+    max_age = HTTP_MAX_AGE if fresh else HTTP_STALE_MAX_AGE
+    return {
+        'ETag': f'"{hashlib.md5(tile_data).hexdigest()}"',
+        'Last-Modified': formatdate(fetched_at, usegmt=True),
+        'Cache-Control': f"public, max-age={max_age}",
+    }
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+def lookup_cached_tile(service, z, x, y, memory=True, disk=True):
+    """Return (tile_data, fetched_at, fresh, source) without going upstream, or None.
+
+    source is 'blank', 'archive', 'memory' or 'disk'. A refresh is scheduled for stale tiles.
+    """
+    if not coverage.covers(z, x, y):
+        return BLANK_TILE, SERVER_STARTED_AT, True, 'blank'
+    if disk:
+        archived = offline_archives.get(service, z, x, y)
+        if archived:
+            return archived[0], archived[1], True, 'archive'
+
+    entry = tile_cache.lookup(service, z, x, y, memory, disk)
+    if entry is None:
+        return None
+    tile_data, fetched_at, tier = entry
+    fresh = tile_cache.is_fresh(fetched_at)
+    if not fresh:
+        schedule_refresh(service, z, x, y)
+    return tile_data, fetched_at, fresh, tier
+
+def record_tile_request(service, z, source, started):
+    metrics.inc('cuzk_tile_requests_total', (('service', service), ('source', source)))
+    metrics.observe('cuzk_tile_request_seconds', (('service', service), ('zoom', str(z))),
+                    time.monotonic() - started)
+
+def render_metrics():
+    """Prometheus text for /metrics: the request metrics plus current cache and queue state."""
+    extra = [('cuzk_refresh_in_progress', (), len(refreshing))]
+    if tile_cache.index:
+        for service, totals in tile_cache.index.totals().items():
+            labels = (('service', service),)
+            extra.append(('cuzk_cache_tiles', labels, totals['tiles']))
+            extra.append(('cuzk_cache_bytes', labels, totals['bytes']))
+            extra.append(('cuzk_cache_max_bytes', labels, CACHE_MAX_BYTES.get(service, 0)))
+    if tile_cache.memory:
+        stats = tile_cache.memory.stats()
+        extra.append(('cuzk_memory_cache_tiles', (), stats['tiles']))
+        extra.append(('cuzk_memory_cache_bytes', (), stats['bytes']))
+        extra.append(('cuzk_memory_cache_evictions_total', (), stats['evictions']))
+    if prefetcher:
+        stats = prefetcher.stats()
+        extra.append(('cuzk_prefetch_queued', (), stats['queued']))
+        extra.append(('cuzk_prefetch_fetched_total', (), stats['fetched']))
+        extra.append(('cuzk_prefetch_dropped_total', (), stats['dropped']))
+    return metrics.render(extra)
+
+def fetch_tile(service, z, x, y):
+    """Return tile bytes for a cache miss, coalescing with requests for the same block."""
+    mx, my, _ = metatile_origin(z, x, y)
+    key = f"{service}/{z}/{mx}/{my}"
+    # A follower may receive a leader's cache hit for a sibling tile; retry once as leader
+    for _ in range(2):
+        tiles = single_flight.do(key, lambda: load_tiles(service, z, x, y)) or {}
+        tile_data = tiles.get((x, y)) or tile_cache.get(service, z, x, y, record_access=False)
+        if tile_data or not tiles:
+            return tile_data
+    return None
+
+class RateLimiter:
+    """Spaces calls per service so that at most `rate` run per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, service):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(service, now))
+            self.next_slot[service] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class Prefetcher:
+    """Low-priority background warming of tiles a client is likely to request next.
+
+    The queue is bounded and deduplicated per metatile block; tiles that are already
+    cached are skipped, and fetches go through single_flight so they merge with
+    foreground requests in flight. Each service is rate-capped separately.
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS, queue_size=PREFETCH_QUEUE_SIZE, rate=PREFETCH_RATE):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.area_quota = max(1, int(queue_size * PREFETCH_AREA_SHARE))
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.limiter = RateLimiter(rate)
+        self.fetched = 0
+        self.dropped = 0
+        for i in range(workers):
+            threading.Thread(target=self.worker, name=f"prefetch-{i}", daemon=True).start()
+
+    def block_key(self, service, z, x, y):
+        mx, my, _ = metatile_origin(z, x, y)
+        return f"{service}/{z}/{mx}/{my}"
+
+    def enqueue(self, service, z, x, y):
+        if not coverage.covers(z, x, y):
+            return False
+        key = self.block_key(service, z, x, y)
+        with self.lock:
+            if key in self.queued:
+                return False
+            self.queued.add(key)
+        try:
+            self.queue.put((service, z, x, y), block=False)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.queued.discard(key)
+                self.dropped += 1
+            return False
+
+    def enqueue_around(self, service, z, x, y):
+        """Queue the 8 neighbours and the 4 next-zoom children of z/x/y."""
+        n = 2 ** z
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if (dx or dy) and 0 <= y + dy < n:
+                    self.enqueue(service, z, (x + dx) % n, y + dy)
+        if z < MAX_ZOOM:
+            for cx in (2 * x, 2 * x + 1):
+                for cy in (2 * y, 2 * y + 1):
+                    self.enqueue(service, z + 1, cx, cy)
+
+    def enqueue_area(self, service, ranges):
+        """Feed every tile of {z: (min_x, max_x, min_y, max_y)} into the queue from a background thread.
+
+        The feed only tops the queue up to area_quota, so neighbours queued by
+        enqueue_around still find room while a large area is warming.
+        """
+        def feed():
+            for z, (min_x, max_x, min_y, max_y) in sorted(ranges.items()):
+                for x in range(min_x, max_x + 1):
+                    for y in range(min_y, max_y + 1):
+                        while self.queue.qsize() >= self.area_quota:
+                            time.sleep(0.1)
+                        self.enqueue(service, z, x, y)
+        threading.Thread(target=feed, name='prefetch-area', daemon=True).start()
+
+    def worker(self):
+        while True:
+            service, z, x, y = self.queue.get()
+            try:
+                if (not offline_archives.get(service, z, x, y) and
+                        not tile_cache.get(service, z, x, y, record_access=False)):
+                    self.limiter.wait(service)
+                    if fetch_tile(service, z, x, y):
+                        with self.lock:
+                            self.fetched += 1
+            except Exception as e:
+                logger.error(f"Prefetch of {service}/{z}/{x}/{y} failed: {e}")
+            finally:
+                with self.lock:
+                    self.queued.discard(self.block_key(service, z, x, y))
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'fetched': self.fetched, 'dropped': self.dropped}
+
+prefetcher = Prefetcher() if PREFETCH_ENABLED else None
+
+def start_area_prefetch(args):
+    """Handle /prefetch?service=&bbox=west,south,east,north&zooms=12-14 (or 12,13,14).
+
+    Returns (body, status).
+    """
+    if prefetcher is None:
+        return {'error': 'prefetch is disabled'}, 503
+    service = args.get('service')
+    if service not in AVAILABLE_SERVICES:
+        return {'error': f"unknown service {service}"}, 400
+    try:
+        bbox = [float(v) for v in args.get('bbox', '').split(',')]
+        zooms_arg = args.get('zooms', '')
+        if '-' in zooms_arg:
+            first, last = (int(v) for v in zooms_arg.split('-'))
+            if not 0 <= first <= last <= MAX_ZOOM:
+                raise ValueError(zooms_arg)
+            zooms = list(range(first, last + 1))
+        else:
+            zooms = [int(v) for v in zooms_arg.split(',')]
+    except ValueError:
+        return {'error': 'expected bbox=west,south,east,north and zooms=12-14 or 12,13,14'}, 400
+    if len(bbox) != 4 or not zooms or min(zooms) < 0 or max(zooms) > MAX_ZOOM:
+        return {'error': 'expected bbox=west,south,east,north and zooms=12-14 or 12,13,14'}, 400
+    if not all(math.isfinite(v) for v in bbox):
+        return {'error': 'bbox coordinates must be finite numbers'}, 400
+    west, south, east, north = bbox
+    if west >= east or south >= north:
+        return {'error': 'bbox must have west < east and south < north'}, 400
+    # mercantile.tile fails at the poles; Web Mercator ends at +-85.0511 degrees
+    west, east = max(west, -180.0), min(east, 180.0)
+    south, north = max(south, -85.0511), min(north, 85.0511)
+
+    # Only tiles inside coverage are fetched, so only those count towards the limit
+    ranges = {}
+    for z in zooms:
+        ul_tile = mercantile.tile(west, north, z)
+        lr_tile = mercantile.tile(east, south, z)
+        clipped = coverage.clip(z, ul_tile.x, lr_tile.x, ul_tile.y, lr_tile.y)
+        if clipped:
+            ranges[z] = clipped
+    tile_count = sum((max_x - min_x + 1) * (max_y - min_y + 1)
+                     for min_x, max_x, min_y, max_y in ranges.values())
+    if tile_count > PREFETCH_MAX_AREA_TILES:
+        return {'error': f"area has {tile_count} tiles, limit is {PREFETCH_MAX_AREA_TILES}"}, 400
+
+    if ranges:
+        prefetcher.enqueue_area(service, ranges)
+    return {'service': service, 'bbox': bbox, 'zooms': zooms, 'tiles': tile_count}, 202
+
+@app.route('/health')
+def health_check():
+    status = {'status': 'ok', 'service': 'CUZK Tile Server'}
+    if tile_cache.memory:
+        status['memory_cache'] = tile_cache.memory.stats()
+    if tile_cache.index:
+        status['disk_cache'] = {service: dict(totals, max_bytes=CACHE_MAX_BYTES.get(service, 0))
+                                for service, totals in tile_cache.index.totals().items()}
+    if offline_archives.archives:
+        status['offline_archives'] = offline_archives.stats()
+    if prefetcher:
+        status['prefetch'] = prefetcher.stats()
+    return status
+
+@app.route('/services')
+def list_services():
+    return {'services': AVAILABLE_SERVICES, 'usage': '/{service}/{z}/{x}/{y}.png'}
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/prefetch')
+def prefetch_area():
+    body, status = start_area_prefetch(request.args)
+    return body, status
+
+@app.route('/<service>/<int:z>/<int:x>/<int:y>.png')
+def get_tile(service, z, x, y):
+    if service not in AVAILABLE_SERVICES:
+        abort(404)
+    if z < 0 or z > MAX_ZOOM:
+        abort(400)
+
+    started = time.monotonic()
+    with metrics.in_flight('cuzk_tile_requests_in_flight'):
+        cached = lookup_cached_tile(service, z, x, y)
+        if cached:
+            tile_data, fetched_at, fresh, source = cached
+        else:
+            tile_data, fetched_at, fresh = fetch_tile(service, z, x, y), time.time(), True
+            source = 'upstream' if tile_data else 'miss'
+            if tile_data and prefetcher:
+                prefetcher.enqueue_around(service, z, x, y)
+    record_tile_request(service, z, source, started)
+    if not tile_data:
+        abort(404)
+
+    headers = tile_headers(tile_data, fetched_at, fresh)
+    if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+        return Response(status=304, headers=headers)
+    return Response(tile_data, mimetype='image/png', headers=headers)
+
+@app.route('/')
+def index():
+    return """<h1>CUZK Tile Server for ATAK</h1>
+    <p>Available services: topo, contours, ortophoto, zmvm, hillshade</p>
+    <p>Usage: /{service}/{z}/{x}/{y}.png</p>
+    <p>Prefetch an area: /prefetch?service=topo&amp;bbox=west,south,east,north&amp;zooms=12-14</p>"""
+
+# Async serving mode (CUZK_SERVER_MODE=async): the same routes on aiohttp, with one
+# pooled keep-alive ClientSession limited to UPSTREAM_CONCURRENCY connections.
+# Disk cache I/O runs in the default executor so it never blocks the event loop.
+
+async def fetch_upstream_async(session, service, url):
+    labels = (('service', service),)
+    with metrics.in_flight('cuzk_upstream_in_flight'):
+        started = time.monotonic()
+        try:
+            async with session.get(url) as response:
+                data = await response.read()
+                metrics.observe('cuzk_upstream_fetch_seconds', labels, time.monotonic() - started)
+                if response.status == 200 and 'image' in response.headers.get('Content-Type', ''):
+                    return data
+                reason = f"http_{response.status}" if response.status != 200 else 'not_image'
+        except asyncio.TimeoutError as e:
+            logger.error(f"Download failed: {e!r}")
+            reason = 'timeout'
+        except Exception as e:
+            logger.error(f"Download failed: {e}")
+            reason = 'connection'
+    metrics.inc('cuzk_upstream_errors_total', labels + (('reason', reason),))
+    return None
+
+async def load_tiles_async(session, service, z, x, y):
+    loop = asyncio.get_running_loop()
+    cached_tile = await loop.run_in_executor(
+        None, lambda: tile_cache.get(service, z, x, y, record_access=False))
+    if cached_tile:
+        return {(x, y): cached_tile}
+
+    mx, my, n = metatile_origin(z, x, y)
+    service_path = AVAILABLE_SERVICES[service]
+    if service == 'hillshade':
+        data = await fetch_upstream_async(session, service, elevation_export_url(mx, my, z, n))
+        tiles = {}
+        if data:
+            try:
+                tiles = await asyncio.wait_for(
+                    loop.run_in_executor(render_pool, render_hillshade_block, data, mx, my, n), RENDER_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Rendering hillshade block {z}/{mx}/{my} took over {RENDER_TIMEOUT}s")
+    elif n == 1:
+        tile_data = await fetch_upstream_async(session, service, arcgis_export_url(service_path, x, y, z))
+        tiles = {(x, y): tile_data} if tile_data else {}
+    else:
+        data = await fetch_upstream_async(session, service, arcgis_metatile_url(service_path, mx, my, z, n))
+        tiles = await loop.run_in_executor(None, slice_metatile, data, mx, my, n) if data else {}
+    await loop.run_in_executor(None, store_tiles, service, z, tiles)
+    return tiles
+
+async def fetch_tile_async(session, service, z, x, y):
+    loop = asyncio.get_running_loop()
+    mx, my, _ = metatile_origin(z, x, y)
+    key = f"{service}/{z}/{mx}/{my}"
+    for _ in range(2):
+        tiles = await single_flight.do_async(key, lambda: load_tiles_async(session, service, z, x, y)) or {}
+        tile_data = tiles.get((x, y)) or await loop.run_in_executor(
+            None, lambda: tile_cache.get(service, z, x, y, record_access=False))
+        if tile_data or not tiles:
+            return tile_data
+    return None
+
+def create_async_app():
+    """Build the aiohttp application (also usable as a gunicorn aiohttp app factory)."""
+    from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+
+    async def start_session(aio_app):
+        aio_app['upstream'] = ClientSession(
+            connector=TCPConnector(limit=UPSTREAM_CONCURRENCY, keepalive_timeout=60),
+            timeout=ClientTimeout(total=UPSTREAM_TIMEOUT),
+            headers={'User-Agent': USER_AGENT})
+
+    async def close_session(aio_app):
+        await aio_app['upstream'].close()
+
+    async def health(request):
+        return web.json_response(health_check())
+
+    async def services(request):
+        return web.json_response(list_services())
+
+    async def prometheus(request):
+        text = await asyncio.get_running_loop().run_in_executor(None, render_metrics)
+        return web.Response(body=text.encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def prefetch(request):
+        body, status = start_area_prefetch(request.query)
+        return web.json_response(body, status=status)
+
+    async def home(request):
+        return web.Response(text=index(), content_type='text/html')
+
+    async def tile(request):
+        service = request.match_info['service']
+        z, x, y = (int(request.match_info[k]) for k in ('z', 'x', 'y'))
+        if service not in AVAILABLE_SERVICES:
+            raise web.HTTPNotFound()
+        if z < 0 or z > MAX_ZOOM:
+            raise web.HTTPBadRequest()
+
+        # Memory hits are answered inline; disk lookups and misses go through the executor
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        with metrics.in_flight('cuzk_tile_requests_in_flight'):
+            cached = (lookup_cached_tile(service, z, x, y, disk=False) or
+                      await loop.run_in_executor(None, lookup_cached_tile, service, z, x, y, False))
+            if cached:
+                tile_data, fetched_at, fresh, source = cached
+            else:
+                tile_data = await fetch_tile_async(request.app['upstream'], service, z, x, y)
+                fetched_at, fresh = time.time(), True
+                source = 'upstream' if tile_data else 'miss'
+                if tile_data and prefetcher:
+                    prefetcher.enqueue_around(service, z, x, y)
+        record_tile_request(service, z, source, started)
+        if not tile_data:
+            raise web.HTTPNotFound()
+
+        headers = tile_headers(tile_data, fetched_at, fresh)
+        if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=tile_data, content_type='image/png', headers=headers)
+
+    aio_app = web.Application()
+    aio_app.on_startup.append(start_session)
+    aio_app.on_cleanup.append(close_session)
+    aio_app.router.add_get('/health', health)
+    aio_app.router.add_get('/services', services)
+    aio_app.router.add_get('/metrics', prometheus)
+    aio_app.router.add_get('/prefetch', prefetch)
+    aio_app.router.add_get('/', home)
+    aio_app.router.add_get(r'/{service}/{z:\d+}/{x:\d+}/{y:\d+}.png', tile)
+    return aio_app
+
+if __name__ == '__main__':
+    if SERVER_MODE == 'async':
+        from aiohttp import web
+        web.run_app(create_async_app(), host='0.0.0.0', port=PORT)
+    else:
+        app.run(host='0.0.0.0', port=PORT, debug=False)
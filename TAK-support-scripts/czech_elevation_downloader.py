@@ -4,22 +4,37 @@ Czech Republic Elevation Data Downloader for ATAK
 Downloads elevation data from Czech CUZK services and creates elevation overlays
 """
 
+import argparse
 import os
 import json
 import sqlite3
-import requests
-import numpy as np
-from PIL import Image, ImageFilter
 import mercantile
-import time
+from functools import partial
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mbtiles_writer import (MBTilesWriter, create_tiles_schema, is_deduplicated, deduplicate_tiles,
+                            recover_deduplication, tile_keys_table)
+from upstream_client import UpstreamClient, FailedJobs, CUZK_BASE_URL
+from coverage_mask import CoverageMask, DEFAULT_BUFFER_KM, report_tile_counts
+from tile_postprocess import TilePostProcessor
+from hillshade import AZIMUTH, ALTITUDE, decode_elevation, render_hillshade, render_tiles
+from dem_pyramid import DemPyramid, TILE_SIZE
+from dem_store import DemStore
+
+HILLSHADE_ZOOMS = [6, 8, 10, 12, 14]
 
 class CzechElevationDownloader:
-    def __init__(self):
-        self.base_url = "https://ags.cuzk.gov.cz/arcgis/rest/services"
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Czech-ATAK-Elevation-Downloader/1.0'
-        })
+    def __init__(self, buffer_km=DEFAULT_BUFFER_KM, max_workers=8, render_workers=None, max_in_flight=None,
+                 dem_store=None, base_url=CUZK_BASE_URL):
+        self.base_url = base_url
+        # Concurrency starts low and adapts up to max_workers to what CUZK tolerates
+        self.client = UpstreamClient('Czech-ATAK-Elevation-Downloader/1.0', initial_concurrency=2,
+                                     max_concurrency=max_workers)
+        self.max_workers = max_workers
+        self.render_workers = render_workers  # Hillshade processes (default: one per CPU)
+        self.max_in_flight = max_in_flight or max_workers * 4  # Submitted but unrendered downloads
+        self.coverage = CoverageMask(buffer_km=buffer_km)  # Tiles within buffer_km of the state border
+        self.dem_store = DemStore(dem_store) if dem_store else None  # Raw elevation kept for re-rendering
     
     def download_elevation_tile(self, x, y, z, service="3D/dmr5g"):
         """Download elevation data tile from DMR service"""
@@ -38,119 +53,105 @@ class CzechElevationDownloader:
                f"interpolation=RSP_BilinearInterpolation&"
                f"f=image")
         
-        try:
-            response = self.session.get(url, timeout=60)
-            if response.status_code == 200:
-                return response.content
-            else:
-                print(f"Failed to download elevation tile {z}/{x}/{y}: HTTP {response.status_code}")
-                return None
-        except Exception as e:
-            print(f"Error downloading elevation tile {z}/{x}/{y}: {e}")
-            return None
+        return self.client.get(url, timeout=60, what=f"elevation tile {z}/{x}/{y}")
     
-    def elevation_to_hillshade(self, elevation_data, azimuth=315, altitude=45):
-        """Convert elevation data to hillshade visualization"""
-        if elevation_data is None or len(elevation_data) == 0:
+    def fetch_elevation(self, x, y, z):
+        """Return an elevation tile as a float32 array (NaN = no data), or None if it could not be downloaded or decoded
+
+        Tiles in the DEM store are read from it; downloaded tiles are added to it.
+        """
+        if self.dem_store:
+            elevation = self.dem_store.get(z, x, y)
+            if elevation is not None:
+                return elevation
+
+        elevation_data = self.download_elevation_tile(x, y, z)
+        if not elevation_data:
             return None
+        elevation = decode_elevation(elevation_data)
+        if elevation is None or elevation.shape != (TILE_SIZE, TILE_SIZE):
+            # Not stored, so the tile is retried instead of becoming a permanent hole
+            print(f"Undecodable elevation for {z}/{x}/{y}")
+            return None
+        if self.dem_store:
+            self.dem_store.put(z, x, y, elevation)
+        return elevation
 
-        try:
-            # Load elevation data as numpy array
-            from io import BytesIO
-
-            # Verify the data is valid before processing
-            if len(elevation_data) < 1000:  # Too small for a valid TIFF
-                return None
-
-            try:
-                img = Image.open(BytesIO(elevation_data))
-                img.load()  # Force loading to detect truncation
-
-                # Check if image has valid dimensions
-                if img.size[0] == 0 or img.size[1] == 0:
-                    return None
-
-            except Exception as e:
-                return None
-
-            # Convert to array with proper error handling
-            try:
-                with np.errstate(invalid='ignore'):
-                    elevation = np.array(img, dtype=np.float64)
-
-                # Check if conversion was successful
-                if elevation.size == 0:
-                    return None
-
-            except Exception:
-                return None
-
-            # Handle no-data values and invalid data
-            elevation[elevation == 0] = np.nan
-            elevation[~np.isfinite(elevation)] = np.nan
-
-            if np.all(np.isnan(elevation)) or elevation.size == 0:
-                return None
+    def load_elevation(self, x, y, z):
+        """Return an elevation tile from the DEM store only, or None if it is not stored"""
+        return self.dem_store.get(z, x, y)
 
-            # Fill NaN values with mean for gradient calculation
-            valid_mask = ~np.isnan(elevation)
-            if np.sum(valid_mask) < 10:  # Too few valid points
+    def elevation_to_hillshade(self, elevation_data, azimuth=AZIMUTH, altitude=ALTITUDE):
+        """Convert elevation data to hillshade visualization (see hillshade.py)"""
+        try:
+            elevation = decode_elevation(elevation_data)
+            if elevation is None:
                 return None
-
-            mean_elevation = np.nanmean(elevation)
-            elevation_filled = elevation.copy()
-            elevation_filled[~valid_mask] = mean_elevation
-
-            # Calculate gradients with full error suppression
-            with np.errstate(all='ignore'):
-                dy, dx = np.gradient(elevation_filled)
-
-                # Handle any remaining invalid values
-                dx = np.nan_to_num(dx, nan=0.0, posinf=0.0, neginf=0.0)
-                dy = np.nan_to_num(dy, nan=0.0, posinf=0.0, neginf=0.0)
-
-                # Clip extreme values to prevent overflow
-                dx = np.clip(dx, -100, 100)
-                dy = np.clip(dy, -100, 100)
-
-                # Calculate slope and aspect
-                slope = np.arctan(np.sqrt(dx*dx + dy*dy))
-                aspect = np.arctan2(-dx, dy)
-
-                # Convert angles to radians
-                azimuth_rad = np.radians(azimuth)
-                altitude_rad = np.radians(altitude)
-
-                # Calculate hillshade
-                hillshade = (np.sin(altitude_rad) * np.sin(slope) +
-                            np.cos(altitude_rad) * np.cos(slope) *
-                            np.cos(azimuth_rad - aspect))
-
-                # Handle any invalid values in hillshade
-                hillshade = np.nan_to_num(hillshade, nan=0.5, posinf=1.0, neginf=0.0)
-
-                # Normalize to 0-255 range
-                hillshade = np.clip(hillshade * 255, 0, 255).astype(np.uint8)
-
-            # Convert back to PIL Image (fix deprecated mode parameter)
-            hillshade_img = Image.fromarray(hillshade).convert('L')
-            
-            # Apply slight blur for smoother appearance
-            hillshade_img = hillshade_img.filter(ImageFilter.GaussianBlur(radius=0.5))
-            
-            # Convert to PNG bytes
-            from io import BytesIO
-            output = BytesIO()
-            hillshade_img.save(output, format='PNG')
-            return output.getvalue()
-            
+            return render_hillshade(elevation, azimuth, altitude)
         except Exception as e:
             print(f"Error processing elevation data: {e}")
             return None
-    
-    def create_hillshade_mbtiles(self, output_file, zoom_levels=[6, 8, 10, 12]):
-        """Create hillshade overlay MBTiles from elevation data"""
+
+    def run_download_jobs(self, executor, jobs, arrived, failed, fetch=None):
+        """Fetch (x, y, zoom) elevation tiles with at most max_in_flight outstanding
+
+        Elevation arrays go to arrived(x, y, zoom, elevation), in the calling
+        thread; tiles that could not be fetched go to failed. fetch defaults
+        to fetch_elevation.
+        """
+        fetch = fetch or self.fetch_elevation
+        in_flight = {}
+
+        def finish(done):
+            for future in done:
+                x, y, zoom = in_flight.pop(future)
+                elevation = future.result()
+                if elevation is not None:
+                    arrived(x, y, zoom, elevation)
+                else:
+                    failed.add([x, y, zoom])
+
+        for x, y, zoom in jobs:
+            if len(in_flight) >= self.max_in_flight:
+                finish(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            # Download elevation data using XYZ coordinates (y, not tms_y)
+            in_flight[executor.submit(fetch, x, y, zoom)] = (x, y, zoom)
+
+        finish(wait(in_flight).done)
+
+    def create_hillshade_mbtiles(self, output_file, zoom_levels=[6, 8, 10, 12], deduplicate=False,
+                                 azimuth=AZIMUTH, altitude=ALTITUDE, pyramid=False, render_only=False):
+        """Create hillshade overlay MBTiles from elevation data
+
+        Elevation tiles are downloaded by max_workers threads, and the float32
+        hillshade and PNG encoding run in a process pool on every core. At most
+        max_in_flight downloads wait to be rendered. Tiles already in the file
+        are skipped, and tiles whose download still fails after a retry pass are
+        saved to <output_file>.failed.json and re-queued first on the next run.
+        With deduplicate, each distinct tile image is stored once (map + images
+        tables); an existing flat database is converted first.
+
+        With pyramid, elevation is downloaded only at the finest zoom level, and
+        the coarser levels are built from it by 2x2 averaging (DemPyramid). A
+        finest-zoom tile is needed if it or any of its ancestors at the
+        requested zoom levels is missing from the file. Pyramid mode always
+        uses a DEM store, so a resumed run rebuilds missing ancestors from
+        stored elevation and downloads only the finest tiles that were never
+        fetched. Without one given, <output_file>.dem is used and removed again
+        once every tile has been created.
+
+        With render_only, nothing is downloaded: every tile is rendered again
+        from the DEM store (for example with a new azimuth or altitude) and
+        replaces the tile in the file. Use the same pyramid setting as the run
+        that filled the store.
+        """
+        if render_only and not self.dem_store:
+            raise ValueError("render_only needs a DEM store")
         print(f"Creating hillshade overlay: {output_file}")
+        temporary_store = pyramid and not self.dem_store
+        if temporary_store:
+            self.dem_store = DemStore(f"{output_file}.dem")
+            print(f"Keeping zoom {max(zoom_levels)} elevation in {self.dem_store.root} until the run completes")
 
         # Check if database exists (for resume functionality)
         db_exists = os.path.exists(output_file)
@@ -168,20 +169,8 @@ class CzechElevationDownloader:
                 )
             ''')
 
-            cursor.execute('''
-                CREATE TABLE tiles (
-                    zoom_level INTEGER,
-                    tile_column INTEGER,
-                    tile_row INTEGER,
-                    tile_data BLOB
-                )
-            ''')
-
-            cursor.execute('''
-                CREATE UNIQUE INDEX tile_index ON tiles (
-                    zoom_level, tile_column, tile_row
-                )
-            ''')
+            # Flat tiles table, or map + images tables with a tiles view
+            create_tiles_schema(conn, deduplicate)
 
             # Insert metadata
             metadata = [
@@ -200,88 +189,194 @@ class CzechElevationDownloader:
             print("Created new MBTiles database")
         else:
             print("Resuming from existing MBTiles database")
-
-        # Get existing tiles for resume functionality
-        cursor.execute('SELECT zoom_level, tile_column, tile_row FROM tiles')
+            if recover_deduplication(conn):
+                print("Finished an interrupted conversion to the deduplicated layout")
+            if deduplicate and not is_deduplicated(conn):
+                print("Converting existing tiles to the deduplicated layout")
+                deduplicate_tiles(conn)
+
+        # Get existing tiles for resume functionality; re-rendering replaces them all
+        cursor.execute(f'SELECT zoom_level, tile_column, tile_row FROM {tile_keys_table(conn)}')
         existing_tiles = set(cursor.fetchall())
+        if render_only:
+            existing_tiles = set()
 
         total_tiles = 0
         processed_tiles = len(existing_tiles)  # Start count from existing tiles
         skipped_tiles = 0
+        writer = MBTilesWriter(output_file)
+        renderer = TilePostProcessor('hillshade', workers=self.render_workers,
+                                     encoder=partial(render_tiles, azimuth=azimuth, altitude=altitude))
+
+        def save(rows):
+            """Runs in the render pool's result thread"""
+            nonlocal processed_tiles
+            writer.write(rows)
+            previous = processed_tiles
+            processed_tiles += len(rows)
+            if processed_tiles // 100 != previous // 100:
+                print(f"Processed {processed_tiles}/{total_tiles} tiles "
+                      f"({processed_tiles/total_tiles*100:.1f}%)")
+
+        def render(x, y, zoom, elevation):
+            # Convert Y coordinate for MBTiles format (TMS)
+            tms_y = (2 ** zoom - 1) - y
+            renderer.submit([(zoom, x, tms_y, elevation)], save)
 
         for zoom in zoom_levels:
-            # Czech Republic official bounds in WGS84 (from ČÚZK)
-            west, south = 12.09, 48.55
-            east, north = 18.86, 51.06
-
-            ul_tile = mercantile.tile(west, north, zoom)
-            lr_tile = mercantile.tile(east, south, zoom)
-
-            level_tiles = (lr_tile.x - ul_tile.x + 1) * (lr_tile.y - ul_tile.y + 1)
+            level_tiles = self.coverage.count(zoom)
             total_tiles += level_tiles
-
             print(f"Processing zoom level {zoom}: {level_tiles} tiles")
 
-            for x in range(ul_tile.x, lr_tile.x + 1):
-                for y in range(ul_tile.y, lr_tile.y + 1):
-                    # Convert Y coordinate for MBTiles format (TMS)
-                    tms_y = (2 ** zoom - 1) - y
-
-                    # Check if tile already exists (resume functionality)
-                    if (zoom, x, tms_y) in existing_tiles:
-                        skipped_tiles += 1
-                        continue
-
-                    # Download elevation data using XYZ coordinates (y, not tms_y)
-                    elevation_data = self.download_elevation_tile(x, y, zoom)
-
-                    if elevation_data:
-                        # Convert to hillshade
-                        hillshade_png = self.elevation_to_hillshade(elevation_data)
-
-                        if hillshade_png:
-                            cursor.execute('''
-                                INSERT OR REPLACE INTO tiles
-                                (zoom_level, tile_column, tile_row, tile_data)
-                                VALUES (?, ?, ?, ?)
-                            ''', (zoom, x, tms_y, hillshade_png))
-
-                            processed_tiles += 1
+        # Tiles that failed in the previous run go first
+        failed = FailedJobs(f"{output_file}.failed.json")
+        requeued = [] if render_only else [tuple(tile) for tile in failed.load()]
+        finest = max(zoom_levels)
+        if pyramid:
+            # Coarser tiles are rebuilt from the finest zoom, which the scan below covers
+            requeued = [tile for tile in requeued if tile[2] == finest]
+        if requeued:
+            print(f"Re-queuing {len(requeued)} tiles that failed in the previous run")
+        requeued_set = set(requeued)
+
+        def missing(zoom):
+            """Tiles inside the border mask that are not in the file yet (resume functionality)"""
+            nonlocal skipped_tiles
+            for x, y in self.coverage.tiles(zoom):
+                if (zoom, x, (2 ** zoom - 1) - y) in existing_tiles:
+                    skipped_tiles += 1
+                else:
+                    yield x, y
+
+        builder = None
+        if pyramid:
+            missing_tiles = {zoom: set(missing(zoom)) for zoom in zoom_levels}
+            coarser = [zoom for zoom in zoom_levels if zoom < finest]
+
+            def needed(z, x, y):
+                return any((x >> (z - zoom), y >> (z - zoom)) in missing_tiles[zoom]
+                           for zoom in zoom_levels if zoom <= z)
+
+            def built(z, x, y, elevation):
+                if z in missing_tiles and (x, y) in missing_tiles[z]:
+                    render(x, y, z, elevation)
+
+            def arrived(x, y, zoom, elevation):
+                built(zoom, x, y, elevation)
+                builder.add(zoom, x, y, elevation)
+
+            builder = DemPyramid(self.coverage, min(zoom_levels), built, needed)
+            jobs = ((x, y, finest) for x, y in self.coverage.tiles(finest)
+                    if needed(finest, x, y) and (x, y, finest) not in requeued_set)
+            print(f"Building zoom levels {', '.join(map(str, coarser))} from zoom {finest} elevation; "
+                  f"tiles in {self.dem_store.root} are read from there")
+        else:
+            arrived = render
+            jobs = ((x, y, zoom) for zoom in zoom_levels for x, y in missing(zoom)
+                    if (x, y, zoom) not in requeued_set)
+
+        if render_only:
+            print(f"Rendering from DEM store {self.dem_store.root} on {renderer.workers} processes")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                self.run_download_jobs(executor, jobs, arrived, failed, fetch=self.load_elevation)
+        else:
+            print(f"Downloading with up to {self.max_workers} connections, "
+                  f"rendering on {renderer.workers} processes")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                self.run_download_jobs(executor, chain(requeued, jobs), arrived, failed)
 
-                            if processed_tiles % 10 == 0:
-                                conn.commit()
-                                print(f"Processed {processed_tiles}/{total_tiles} tiles "
-                                      f"({processed_tiles/total_tiles*100:.1f}%)")
+                # One more attempt for tiles that failed during this run
+                retry = failed.take()
+                if retry:
+                    print(f"Retrying {len(retry)} failed tiles")
+                    self.run_download_jobs(executor, retry, arrived, failed)
 
-                    # Be nice to the server
-                    time.sleep(0.5)
-        
-        conn.commit()
         conn.close()
+        renderer.close()
+        writer.close()
 
         if skipped_tiles > 0:
             print(f"Skipped {skipped_tiles} existing tiles")
 
+        if builder and builder.pending():
+            print(f"{builder.pending()} coarser tiles were not built because part of their elevation is missing")
+        if render_only:
+            not_stored = len(failed.take())
+            if not_stored:
+                print(f"{not_stored} tiles are not in the DEM store and were skipped")
+        else:
+            still_failed = failed.save()
+            if still_failed:
+                print(f"{still_failed} tiles still failed; saved to {failed.path} for the next run")
+            print(f"Upstream: {self.client.summary()}")
+            if temporary_store:
+                if still_failed or (builder and builder.pending()):
+                    print(f"Keeping {self.dem_store.root} for resuming")
+                else:
+                    self.dem_store.remove()
+                    print(f"Removed {self.dem_store.root}")
+                    self.dem_store = None
         print(f"Hillshade creation complete: {processed_tiles}/{total_tiles} tiles")
         return processed_tiles
 
 def main():
     """Main function to create elevation overlays"""
-    downloader = CzechElevationDownloader()
+    parser = argparse.ArgumentParser(description="Create a Czech hillshade overlay from CUZK elevation data for ATAK")
+    parser.add_argument('--buffer-km', type=float, default=DEFAULT_BUFFER_KM,
+                        help="Also create tiles within this distance of the border (default: %(default)s)")
+    parser.add_argument('--count-only', action='store_true',
+                        help="Print how many tiles would be created and exit")
+    parser.add_argument('--deduplicate', action='store_true',
+                        help="Store each distinct tile image once")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Maximum concurrent elevation downloads (default: %(default)s)")
+    parser.add_argument('--render-workers', type=int, default=None,
+                        help="Hillshade rendering processes (default: one per CPU)")
+    parser.add_argument('--pyramid', action='store_true',
+                        help="Download elevation only at the finest zoom and build the coarser levels from it "
+                             "(keeps that elevation in --dem-store for resuming; without --dem-store, next to the "
+                             "output file until the run completes)")
+    parser.add_argument('--dem-store', metavar='DIR',
+                        help="Keep raw elevation tiles in DIR and reuse them instead of downloading again")
+    parser.add_argument('--render-only', action='store_true',
+                        help="Re-render every hillshade tile from --dem-store without network access")
+    parser.add_argument('--azimuth', type=float, default=AZIMUTH,
+                        help="Light direction in degrees (default: %(default)s)")
+    parser.add_argument('--altitude', type=float, default=ALTITUDE,
+                        help="Light height above the horizon in degrees (default: %(default)s)")
+    parser.add_argument('--base-url', default=CUZK_BASE_URL,
+                        help="ArcGIS REST services root (default: %(default)s)")
+    args = parser.parse_args()
+    if args.render_only and not args.dem_store:
+        parser.error("--render-only needs --dem-store")
+
+    downloader = CzechElevationDownloader(buffer_km=args.buffer_km, max_workers=args.workers,
+                                          render_workers=args.render_workers, dem_store=args.dem_store,
+                                          base_url=args.base_url)
     
+    print("Czech Republic Elevation Data Downloader")
+    print("========================================")
+
+    print("\nHillshade tiles:")
+    report_tile_counts(downloader.coverage, HILLSHADE_ZOOMS)
+    if args.count_only:
+        return
+
     # Create output directory
     output_dir = "downloaded_maps"
     os.makedirs(output_dir, exist_ok=True)
     
-    print("Czech Republic Elevation Data Downloader")
-    print("========================================")
-    
     # Create hillshade overlay
     hillshade_file = os.path.join(output_dir, "czech_hillshade.mbtiles")
     print(f"\nCreating hillshade overlay...")
     downloader.create_hillshade_mbtiles(
         hillshade_file,
-        zoom_levels=[6, 8, 10, 12, 14]
+        zoom_levels=HILLSHADE_ZOOMS,
+        deduplicate=args.deduplicate,
+        azimuth=args.azimuth,
+        altitude=args.altitude,
+        pyramid=args.pyramid,
+        render_only=args.render_only
     )
     
     print(f"\n✓ Elevation overlay created successfully!")
@@ -5,40 +5,37 @@ Downloads topographical maps and elevation data from Czech CUZK services
 and prepares them for use in ATAK (Android Team Awareness Kit)
 """
 
+import argparse
 import os
 import sqlite3
-import requests
 import mercantile
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from io import BytesIO
+from itertools import chain
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mbtiles_writer import (MBTilesWriter, create_tiles_schema, is_deduplicated, deduplicate_tiles,
+                            recover_deduplication, tile_keys_table)
+from upstream_client import UpstreamClient, FailedJobs, CUZK_BASE_URL
+from coverage_mask import CoverageMask, DEFAULT_BUFFER_KM, report_tile_counts
+from tile_postprocess import TilePostProcessor, TILE_FORMATS, resolve_tile_format
+
+BASE_MAP_ZOOMS = [6, 8, 10, 12, 14, 16]
+CONTOUR_ZOOMS = [6, 8, 10, 12, 14]
 
 class CzechMapDownloader:
-    def __init__(self, max_workers=8):
-        self.base_url = "https://ags.cuzk.gov.cz/arcgis/rest/services"
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Czech-ATAK-Map-Downloader/1.0'
-        })
+    def __init__(self, max_workers=16, metatile=4, max_in_flight=None, buffer_km=DEFAULT_BUFFER_KM,
+                 base_url=CUZK_BASE_URL):
+        self.base_url = base_url
+        # Concurrency adapts between 1 and max_workers to what CUZK tolerates
+        self.client = UpstreamClient('Czech-ATAK-Map-Downloader/1.0', max_concurrency=max_workers)
         self.max_workers = max_workers
-        self.lock = threading.Lock()
+        self.metatile = metatile  # Download NxN tile blocks per export request (1 = single tiles)
+        self.max_in_flight = max_in_flight or max_workers * 4  # Submitted but unsaved downloads
+        self.coverage = CoverageMask(buffer_km=buffer_km)  # Tiles within buffer_km of the state border
         
     def get_tile_bounds_czech_republic(self, zoom_level=12):
-        """Get tile bounds for Czech Republic at given zoom level"""
-        # Czech Republic official bounds in WGS84 (from ČÚZK)
-        west, south = 12.09, 48.55   # Southwest corner
-        east, north = 18.86, 51.06   # Northeast corner
-        
-        # Convert to tile coordinates
-        ul_tile = mercantile.tile(west, north, zoom_level)
-        lr_tile = mercantile.tile(east, south, zoom_level)
-        
-        return {
-            'min_x': ul_tile.x,
-            'max_x': lr_tile.x,
-            'min_y': ul_tile.y,
-            'max_y': lr_tile.y,
-            'zoom': zoom_level
-        }
+        """Get the bounding tile range of the Czech coverage mask at given zoom level"""
+        return self.coverage.tile_bounds(zoom_level)
     
     def download_arcgis_tile(self, service_name, x, y, z, image_format='png'):
         """Download a single tile from ArcGIS REST service"""
@@ -57,19 +54,53 @@ class CzechMapDownloader:
                f"transparent=true&"
                f"f=image")
         
+        return self.client.get(url, timeout=30, what=f"tile {z}/{x}/{y}")
+    
+    def download_arcgis_metatile(self, service_name, mx, my, z, size, image_format='png'):
+        """Download a size x size block of tiles as one image and slice it into tiles
+
+        (mx, my) is the top-left tile of the block. One large export replaces
+        size*size requests, and labels are not clipped at the inner tile seams.
+        Returns {(x, y): tile_data}, or an empty dict on failure.
+        """
+        west, _, _, north = mercantile.xy_bounds(mx, my, z)
+        _, south, east, _ = mercantile.xy_bounds(mx + size - 1, my + size - 1, z)
+        pixels = 256 * size
+
+        url = (f"{self.base_url}/{service_name}/MapServer/export?"
+               f"bbox={west},{south},{east},{north}&"
+               f"bboxSR=3857&"
+               f"imageSR=3857&"
+               f"size={pixels},{pixels}&"
+               f"format={image_format}&"
+               f"transparent=true&"
+               f"f=image")
+
+        data = self.client.get(url, timeout=60, what=f"metatile {z}/{mx}/{my}")
+        if data is None:
+            return {}
         try:
-            response = self.session.get(url, timeout=30)
-            if response.status_code == 200:
-                return response.content
-            else:
-                print(f"Failed to download tile {z}/{x}/{y}: HTTP {response.status_code}")
-                return None
+            img = Image.open(BytesIO(data))
+            img.load()
         except Exception as e:
-            print(f"Error downloading tile {z}/{x}/{y}: {e}")
-            return None
-    
-    def create_mbtiles_database(self, filepath, name, description="Czech Republic Topographical Map"):
-        """Create an MBTiles SQLite database"""
+            print(f"Error decoding metatile {z}/{mx}/{my}: {e}")
+            return {}
+
+        if img.size != (pixels, pixels):
+            print(f"Unexpected metatile size {img.size} for {z}/{mx}/{my}")
+            return {}
+
+        tiles = {}
+        for dx in range(size):
+            for dy in range(size):
+                output = BytesIO()
+                img.crop((dx * 256, dy * 256, (dx + 1) * 256, (dy + 1) * 256)).save(output, format='PNG')
+                tiles[(mx + dx, my + dy)] = output.getvalue()
+        return tiles
+
+    def create_mbtiles_database(self, filepath, name, description="Czech Republic Topographical Map",
+                                deduplicate=False, tile_format='png'):
+        """Create an MBTiles SQLite database, optionally with the deduplicated layout"""
         conn = sqlite3.connect(filepath)
         cursor = conn.cursor()
         
@@ -80,30 +111,17 @@ class CzechMapDownloader:
                 value TEXT
             )
         ''')
-        
-        cursor.execute('''
-            CREATE TABLE tiles (
-                zoom_level INTEGER,
-                tile_column INTEGER,
-                tile_row INTEGER,
-                tile_data BLOB
-            )
-        ''')
-        
-        # Create unique index
-        cursor.execute('''
-            CREATE UNIQUE INDEX tile_index ON tiles (
-                zoom_level, tile_column, tile_row
-            )
-        ''')
-        
+
+        # Flat tiles table, or map + images tables with a tiles view
+        create_tiles_schema(conn, deduplicate)
+
         # Insert metadata
         metadata = [
             ('name', name),
             ('type', 'baselayer'),
             ('version', '1.0'),
             ('description', description),
-            ('format', 'png'),
+            ('format', tile_format),
             ('bounds', '12.09,48.55,18.86,51.06'),  # Czech Republic official bounds
             ('minzoom', '8'),
             ('maxzoom', '16')
@@ -125,123 +143,258 @@ class CzechMapDownloader:
             return (z, x, tms_y, tile_data)
         return None
 
+    def download_metatile_worker(self, service_name, mx, my, z, size, wanted):
+        """Worker function to download one metatile block, keeping only the wanted tiles"""
+        tiles = self.download_arcgis_metatile(service_name, mx, my, z, size)
+        return [(z, x, self.tms_to_xyz(y, z), tile_data)
+                for (x, y), tile_data in tiles.items() if (x, y) in wanted]
+
+    def iter_download_jobs(self, conn, zoom_levels):
+        """Yield (mx, my, zoom, size, wanted) for each metatile block with missing tiles
+
+        Only tiles inside the coverage mask are wanted. Existing tiles are
+        looked up one block column at a time (resume functionality), so memory
+        use stays flat however many zoom levels are requested, and the first
+        jobs are ready immediately.
+        """
+        table = tile_keys_table(conn)
+        for zoom in zoom_levels:
+            bounds = self.get_tile_bounds_czech_republic(zoom)
+            size = min(self.metatile, 2 ** zoom)
+            for mx in range(bounds['min_x'] - bounds['min_x'] % size, bounds['max_x'] + 1, size):
+                xs = range(max(mx, bounds['min_x']), min(mx + size, bounds['max_x'] + 1))
+                rows = conn.execute(f'''
+                    SELECT tile_column, tile_row FROM {table}
+                    WHERE zoom_level=? AND tile_column BETWEEN ? AND ?
+                ''', (zoom, xs[0], xs[-1])).fetchall()
+                existing = {(x, self.tms_to_xyz(tms_y, zoom)) for x, tms_y in rows}
+
+                for my in range(bounds['min_y'] - bounds['min_y'] % size, bounds['max_y'] + 1, size):
+                    # Keep only tiles inside the border mask that don't exist yet
+                    wanted = {
+                        (x, y)
+                        for x in xs
+                        for y in range(max(my, bounds['min_y']), min(my + size, bounds['max_y'] + 1))
+                        if (x, y) not in existing and self.coverage.covers(zoom, x, y)
+                    }
+                    if wanted:
+                        yield mx, my, zoom, size, wanted
+
+    def run_download_jobs(self, executor, service, jobs, save, failed):
+        """Submit jobs with at most max_in_flight outstanding; jobs that return no tiles go to failed"""
+        in_flight = {}
+        requests_made = 0
+
+        def finish(done):
+            for future in done:
+                mx, my, z, size, wanted = in_flight.pop(future)
+                if not save(future.result()):
+                    failed.add([mx, my, z, size, sorted(wanted)])
+
+        for mx, my, z, size, wanted in jobs:
+            if len(in_flight) >= self.max_in_flight:
+                finish(wait(in_flight, return_when=FIRST_COMPLETED).done)
+
+            if size == 1:
+                future = executor.submit(self.download_tile_worker, service, mx, my, z)
+            else:
+                future = executor.submit(self.download_metatile_worker, service, mx, my, z, size, wanted)
+            in_flight[future] = (mx, my, z, size, wanted)
+            requests_made += 1
+
+        finish(wait(in_flight).done)
+        return requests_made
+
     def download_topographic_maps(self, output_file, zoom_levels=[6, 8, 10, 12, 14],
-                                 service='ZABAGED_POLOHOPIS'):
+                                 service='ZABAGED_POLOHOPIS', deduplicate=False, tile_format='png',
+                                 postprocess_workers=None):
         """
         Download Czech topographical maps with resume functionality and parallelization
 
+        Download jobs are generated lazily and at most max_in_flight of them are
+        submitted at a time, so memory use does not grow with the number of tiles.
+        Unless tile_format is 'png', finished tiles are re-encoded in a process pool
+        (TilePostProcessor) before they go to an MBTilesWriter thread that commits
+        them in batches.
+        Requests that fail after the client's retries are retried once more at the
+        end, and the rest are saved to <output_file>.failed.json and re-queued
+        first on the next run.
+
         Args:
             output_file: Output MBTiles file path
             zoom_levels: List of zoom levels to download
             service: ArcGIS service name to use
+            deduplicate: Store each distinct tile image once (map + images tables);
+                an existing flat database is converted first
+            tile_format: A tile_postprocess.TILE_FORMATS name, or 'auto' for the
+                service's default; sets the MBTiles format metadata
+            postprocess_workers: Re-encoding processes (default: one per CPU)
         """
         print(f"Starting download of {service} maps to {output_file}")
+        tile_format = resolve_tile_format(tile_format, service)
+        mbtiles_format = TILE_FORMATS[tile_format]
 
         # Check if database exists (for resume functionality)
         db_exists = os.path.exists(output_file)
 
         if not db_exists:
-            conn = self.create_mbtiles_database(output_file, f"Czech {service}")
+            conn = self.create_mbtiles_database(output_file, f"Czech {service}", deduplicate=deduplicate,
+                                                tile_format=mbtiles_format)
             print("Created new MBTiles database")
         else:
             conn = sqlite3.connect(output_file)
             print("Resuming from existing MBTiles database")
+            if recover_deduplication(conn):
+                print("Finished an interrupted conversion to the deduplicated layout")
+            row = conn.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+            if row and row[0] != mbtiles_format:
+                conn.close()
+                raise ValueError(f"{output_file} holds {row[0]} tiles, not {mbtiles_format}; "
+                                 f"use a matching tile format or a new file")
+            if deduplicate and not is_deduplicated(conn):
+                print("Converting existing tiles to the deduplicated layout")
+                deduplicate_tiles(conn)
 
         cursor = conn.cursor()
+        table = tile_keys_table(conn)
 
-        # Get existing tiles for resume functionality
-        cursor.execute('SELECT zoom_level, tile_column, tile_row FROM tiles')
-        existing_tiles = set(cursor.fetchall())
-
-        # Generate list of all tiles to download
-        all_tiles = []
         total_tiles = 0
-
+        skipped_tiles = 0
         for zoom in zoom_levels:
-            bounds = self.get_tile_bounds_czech_republic(zoom)
-            level_tiles = ((bounds['max_x'] - bounds['min_x'] + 1) *
-                          (bounds['max_y'] - bounds['min_y'] + 1))
+            level_tiles = self.coverage.count(zoom)
             total_tiles += level_tiles
-
+            cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE zoom_level=?', (zoom,))
+            skipped_tiles += cursor.fetchone()[0]
             print(f"Processing zoom level {zoom}: {level_tiles} tiles")
 
-            for x in range(bounds['min_x'], bounds['max_x'] + 1):
-                for y in range(bounds['min_y'], bounds['max_y'] + 1):
-                    tms_y = self.tms_to_xyz(y, zoom)
-
-                    # Check if tile already exists (resume functionality)
-                    if (zoom, x, tms_y) not in existing_tiles:
-                        all_tiles.append((service, x, y, zoom))
-
-        downloaded_tiles = len(existing_tiles)
-        skipped_tiles = len(existing_tiles)
+        downloaded_tiles = skipped_tiles
 
         if skipped_tiles > 0:
             print(f"Skipping {skipped_tiles} existing tiles")
 
-        print(f"Downloading {len(all_tiles)} remaining tiles using {self.max_workers} parallel workers")
+        print(f"Downloading {total_tiles - skipped_tiles} remaining tiles "
+              f"using {self.max_workers} parallel workers")
 
-        # Download tiles in parallel
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            # Submit all download tasks
-            future_to_tile = {
-                executor.submit(self.download_tile_worker, service, x, y, z): (x, y, z)
-                for service, x, y, z in all_tiles
-            }
+        writer = MBTilesWriter(output_file)
+        processor = None
+        if tile_format != 'png':
+            processor = TilePostProcessor(tile_format, workers=postprocess_workers)
+            print(f"Re-encoding tiles as {tile_format} using {processor.workers} processes")
 
-            # Process completed downloads
-            for future in as_completed(future_to_tile):
-                result = future.result()
+        def save(result):
+            nonlocal downloaded_tiles
+            if not result:
+                return False
+            results = result if isinstance(result, list) else [result]
+            if processor:
+                processor.submit(results, writer.write)
+            else:
+                writer.write(results)
+
+            previous = downloaded_tiles
+            downloaded_tiles += len(results)
 
-                if result:
-                    z, x, tms_y, tile_data = result
+            if downloaded_tiles // 50 != previous // 50:
+                print(f"Downloaded {downloaded_tiles}/{total_tiles} tiles "
+                      f"({downloaded_tiles/total_tiles*100:.1f}%)")
+            return True
 
-                    with self.lock:
-                        cursor.execute('''
-                            INSERT OR REPLACE INTO tiles
-                            (zoom_level, tile_column, tile_row, tile_data)
-                            VALUES (?, ?, ?, ?)
-                        ''', (z, x, tms_y, tile_data))
+        # Requests that failed last time go first; the scan skips their blocks
+        failed = FailedJobs(f"{output_file}.failed.json")
+        requeued = [(mx, my, z, size, {tuple(t) for t in wanted})
+                    for mx, my, z, size, wanted in failed.load()]
+        if requeued:
+            print(f"Re-queuing {len(requeued)} requests that failed in the previous run")
+        requeued_blocks = {(z, mx, my) for mx, my, z, _, _ in requeued}
+        jobs = chain(requeued, (job for job in self.iter_download_jobs(conn, zoom_levels)
+                                if (job[2], job[0], job[1]) not in requeued_blocks))
 
-                        downloaded_tiles += 1
+        # Download tiles in parallel, keeping a bounded number of jobs in flight
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            requests_made = self.run_download_jobs(executor, service, jobs, save, failed)
 
-                        if downloaded_tiles % 50 == 0:
-                            conn.commit()
-                            print(f"Downloaded {downloaded_tiles}/{total_tiles} tiles "
-                                  f"({downloaded_tiles/total_tiles*100:.1f}%)")
+            retry = failed.take()
+            if retry:
+                print(f"Retrying {len(retry)} failed requests")
+                retry_jobs = [(mx, my, z, size, {tuple(t) for t in wanted})
+                              for mx, my, z, size, wanted in retry]
+                requests_made += self.run_download_jobs(executor, service, retry_jobs, save, failed)
 
-        conn.commit()
         conn.close()
+        if processor:
+            processor.close()
+        writer.close()
 
-        print(f"Download complete: {downloaded_tiles}/{total_tiles} tiles saved to {output_file}")
+        still_failed = failed.save()
+        if still_failed:
+            print(f"{still_failed} requests still failed; saved to {failed.path} for the next run")
+        print(f"Upstream: {self.client.summary()}")
+        if processor:
+            print(f"Re-encoded: {processor.summary()}")
+        print(f"Download complete: {downloaded_tiles}/{total_tiles} tiles saved to {output_file} "
+              f"({requests_made} requests)")
         return downloaded_tiles
-    
-    def download_contour_overlay(self, output_file, zoom_levels=[6, 8, 10, 12, 14]):
-        """Download contour lines as a separate overlay"""
+
+    def download_contour_overlay(self, output_file, zoom_levels=[6, 8, 10, 12, 14], deduplicate=True,
+                                 tile_format='png', postprocess_workers=None):
+        """Download contour lines as a separate overlay
+
+        Most contour tiles are empty and identical, so the overlay is
+        deduplicated by default.
+        """
         return self.download_topographic_maps(
             output_file, 
             zoom_levels, 
-            service='ZABAGED_VRSTEVNICE'
+            service='ZABAGED_VRSTEVNICE',
+            deduplicate=deduplicate,
+            tile_format=tile_format,
+            postprocess_workers=postprocess_workers
         )
 
 def main():
     """Main function to download Czech maps for ATAK"""
-    downloader = CzechMapDownloader()
+    parser = argparse.ArgumentParser(description="Download Czech topographic maps from CUZK as MBTiles for ATAK")
+    parser.add_argument('--buffer-km', type=float, default=DEFAULT_BUFFER_KM,
+                        help="Also download tiles within this distance of the border (default: %(default)s)")
+    parser.add_argument('--count-only', action='store_true',
+                        help="Print how many tiles would be downloaded and exit")
+    parser.add_argument('--deduplicate', action='store_true',
+                        help="Store each distinct base map tile image once (the contour overlay always is)")
+    parser.add_argument('--tile-format', choices=list(TILE_FORMATS) + ['auto'], default='png',
+                        help="Re-encode tiles before storing them; auto picks per service "
+                             "(default: %(default)s, stored as downloaded)")
+    parser.add_argument('--postprocess-workers', type=int, default=None,
+                        help="Processes for re-encoding tiles (default: one per CPU)")
+    parser.add_argument('--base-url', default=CUZK_BASE_URL,
+                        help="ArcGIS REST services root (default: %(default)s)")
+    args = parser.parse_args()
+
+    downloader = CzechMapDownloader(buffer_km=args.buffer_km, base_url=args.base_url)
     
+    print("Czech Republic ATAK Map Downloader")
+    print("==================================")
+
+    print("\nBase map tiles:")
+    report_tile_counts(downloader.coverage, BASE_MAP_ZOOMS)
+    print("Contour tiles:")
+    report_tile_counts(downloader.coverage, CONTOUR_ZOOMS)
+    if args.count_only:
+        return
+
     # Create output directory
     output_dir = "downloaded_maps"
     os.makedirs(output_dir, exist_ok=True)
     
-    print("Czech Republic ATAK Map Downloader")
-    print("==================================")
-    
     # Download base topographic map
     base_map_file = os.path.join(output_dir, "czech_topographic.mbtiles")
     print("\n1. Downloading base topographic map (ZABAGED_POLOHOPIS)...")
     downloader.download_topographic_maps(
         base_map_file, 
-        zoom_levels=[6, 8, 10, 12, 14, 16],
-        service='ZABAGED_POLOHOPIS'
+        zoom_levels=BASE_MAP_ZOOMS,
+        service='ZABAGED_POLOHOPIS',
+        deduplicate=args.deduplicate,
+        tile_format=args.tile_format,
+        postprocess_workers=args.postprocess_workers
     )
     
     # Download contour lines
@@ -249,7 +402,9 @@ def main():
     print("\n2. Downloading contour lines overlay...")
     downloader.download_contour_overlay(
         contour_file,
-        zoom_levels=[6, 8, 10, 12, 14]
+        zoom_levels=CONTOUR_ZOOMS,
+        tile_format=args.tile_format,
+        postprocess_workers=args.postprocess_workers
     )
     
     print(f"\n✓ Maps downloaded successfully!")
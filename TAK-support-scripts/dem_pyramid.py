@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Coarser DEM zoom levels built locally from the finest one by 2x2 averaging
+"""
+
+import numpy as np
+
+TILE_SIZE = 256
+
+def downsample(elevation):
+    """Average 2x2 pixel blocks of a float32 array, ignoring NaN (no data)
+
+    Blocks that are entirely NaN stay NaN.
+    """
+    height, width = elevation.shape
+    blocks = elevation.reshape(height // 2, 2, width // 2, 2)
+    valid = ~np.isnan(blocks)
+    total = np.where(valid, blocks, np.float32(0)).sum(axis=(1, 3), dtype=np.float32)
+    count = valid.sum(axis=(1, 3))
+    empty = count == 0
+    np.divide(total, count, out=total, where=~empty)
+    total[empty] = np.nan
+    return total
+
+class DemPyramid:
+    """Assemble parent DEM tiles from their children as the children arrive
+
+    add() takes a tile and writes its downsampled quarter into the parent's
+    buffer. A parent is complete when all of its children inside the coverage
+    mask have arrived. It is then passed to on_tile(z, x, y, elevation) and
+    added one level up in turn, until min_zoom. needed(z, x, y) decides
+    whether a parent is wanted at all, so nothing is buffered for parts of
+    the tree that are not being rebuilt. When the finest zoom is fed row by
+    row, only a few rows of parent tiles per level are held at a time.
+    """
+
+    def __init__(self, coverage, min_zoom, on_tile, needed=None):
+        self.coverage = coverage
+        self.min_zoom = min_zoom
+        self.on_tile = on_tile
+        self.needed = needed or (lambda z, x, y: True)
+        self.partial = {}  # (z, x, y) -> [elevation, children still expected]
+
+    def expected_children(self, z, x, y):
+        return sum(self.coverage.covers(z + 1, cx, cy)
+                   for cx in (2 * x, 2 * x + 1) for cy in (2 * y, 2 * y + 1))
+
+    def add(self, z, x, y, elevation):
+        half = TILE_SIZE // 2
+        while z > self.min_zoom:
+            parent = (z - 1, x // 2, y // 2)
+            if not self.needed(*parent):
+                return
+
+            entry = self.partial.get(parent)
+            if entry is None:
+                entry = self.partial[parent] = [
+                    np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32),
+                    self.expected_children(*parent)]
+            qx, qy = x % 2, y % 2
+            entry[0][qy * half:(qy + 1) * half, qx * half:(qx + 1) * half] = downsample(elevation)
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+
+            del self.partial[parent]
+            z, x, y = parent
+            elevation = entry[0]
+            self.on_tile(z, x, y, elevation)
+
+    def pending(self):
+        """Number of parent tiles still waiting for children (for example after failed downloads)"""
+        return len(self.partial)
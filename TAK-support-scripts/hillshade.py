@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Hillshade rendering of DMR5G elevation tiles, run in the elevation downloader's worker processes
+"""
+
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageFilter
+
+AZIMUTH = 315   # degrees, light from the north-west
+ALTITUDE = 45   # degrees above the horizon
+
+def decode_elevation(elevation_data):
+    """Decode a float32 GeoTIFF from exportImage; no-data pixels (0) become NaN. None if invalid."""
+    if elevation_data is None or len(elevation_data) < 1000:  # Too small for a valid TIFF
+        return None
+    try:
+        img = Image.open(BytesIO(elevation_data))
+        img.load()  # Force loading to detect truncation
+        if img.size[0] == 0 or img.size[1] == 0:
+            return None
+        elevation = np.array(img, dtype=np.float32)
+    except Exception:
+        return None
+
+    elevation[elevation == 0] = np.nan
+    return elevation
+
+def shade(elevation, azimuth=AZIMUTH, altitude=ALTITUDE):
+    """Return the 0-255 hillshade of a gap-free float32 elevation array
+
+    Same model as the original float64 code: slope and aspect from pixel
+    gradients clipped to +-100, shaded as
+    sin(alt) sin(slope) + cos(alt) cos(slope) cos(az - aspect).
+    sin/cos of slope and aspect are taken straight from the gradients, and
+    every step writes into the gradient arrays, so apart from np.gradient
+    only two extra float32 arrays are allocated.
+    """
+    azimuth_rad = np.radians(azimuth)
+    altitude_rad = np.radians(altitude)
+
+    dy, dx = np.gradient(elevation)
+    np.clip(dx, -100, 100, out=dx)
+    np.clip(dy, -100, 100, out=dy)
+
+    # |gradient| = tan(slope), so cos(slope) = 1 / sqrt(1 + g^2) and sin(slope) = g cos(slope)
+    g = np.hypot(dx, dy)
+    cos_slope = np.multiply(g, g)
+    cos_slope += 1
+    np.sqrt(cos_slope, out=cos_slope)
+    np.reciprocal(cos_slope, out=cos_slope)
+
+    # aspect = arctan2(-dx, dy), so cos(az - aspect) = (cos(az) dy - sin(az) dx) / g,
+    # and cos(az) where the ground is flat (g = 0)
+    dy *= np.float32(np.cos(azimuth_rad))
+    dx *= np.float32(np.sin(azimuth_rad))
+    dy -= dx
+    flat = g == 0
+    np.divide(dy, g, out=dy, where=~flat)
+    dy[flat] = np.cos(azimuth_rad)
+
+    g *= np.float32(np.sin(altitude_rad))
+    dy *= np.float32(np.cos(altitude_rad))
+    g += dy
+    g *= cos_slope
+
+    g *= 255
+    np.clip(g, 0, 255, out=g)
+    return g.astype(np.uint8)
+
+def render_hillshade(elevation, azimuth=AZIMUTH, altitude=ALTITUDE):
+    """Render a float32 elevation array (NaN = no data) as a hillshade PNG; None if mostly empty"""
+    valid = np.isfinite(elevation)
+    if np.count_nonzero(valid) < 10:  # Too few valid points
+        return None
+
+    # Fill no-data with the mean for the gradient calculation
+    if not valid.all():
+        elevation = elevation.copy()
+        elevation[~valid] = elevation[valid].mean()
+
+    hillshade_img = Image.fromarray(shade(elevation, azimuth, altitude), mode='L')
+
+    # Apply slight blur for smoother appearance
+    hillshade_img = hillshade_img.filter(ImageFilter.GaussianBlur(radius=0.5))
+
+    output = BytesIO()
+    hillshade_img.save(output, format='PNG')
+    return output.getvalue()
+
+def render_tiles(rows, azimuth=AZIMUTH, altitude=ALTITUDE):
+    """Render (zoom_level, tile_column, tile_row, elevation) rows as hillshade PNG rows
+
+    elevation is a float32 array or the GeoTIFF bytes from exportImage. Tiles
+    without enough elevation data are left out.
+    """
+    tiles = []
+    for z, x, y, elevation in rows:
+        try:
+            if isinstance(elevation, bytes):
+                elevation = decode_elevation(elevation)
+            hillshade_png = render_hillshade(elevation, azimuth, altitude) if elevation is not None else None
+        except Exception as e:
+            print(f"Error processing elevation data for {z}/{x}/{y}: {e}")
+            continue
+        if hillshade_png:
+            tiles.append((z, x, y, hillshade_png))
+    return tiles
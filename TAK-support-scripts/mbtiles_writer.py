@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Batched MBTiles writer shared by the Czech map and elevation downloaders
+"""
+
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+def tile_id(tile_data):
+    return hashlib.md5(tile_data).hexdigest()
+
+def create_tiles_schema(conn, deduplicate=False):
+    """Create the flat tiles table, or the deduplicated layout
+
+    The deduplicated layout stores each distinct image once in images, keyed by
+    content hash, and points map rows at it. A tiles view joins the two, so
+    readers (ATAK, resume lookups) see the same tiles table either way.
+    """
+    if not deduplicate:
+        conn.execute('''
+            CREATE TABLE tiles (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                tile_data BLOB
+            )
+        ''')
+        conn.execute('''
+            CREATE UNIQUE INDEX tile_index ON tiles (
+                zoom_level, tile_column, tile_row
+            )
+        ''')
+        return
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS map (
+            zoom_level INTEGER,
+            tile_column INTEGER,
+            tile_row INTEGER,
+            tile_id TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (
+            zoom_level, tile_column, tile_row
+        )
+    ''')
+    conn.execute('CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)')
+    conn.execute('''
+        CREATE VIEW IF NOT EXISTS tiles AS
+        SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+               map.tile_row AS tile_row, images.tile_data AS tile_data
+        FROM map JOIN images ON images.tile_id = map.tile_id
+    ''')
+
+def is_deduplicated(conn):
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+    return kind is not None and kind[0] == 'view'
+
+def tile_keys_table(conn):
+    """Table to look up which tiles exist; map avoids joining images through the view"""
+    return 'map' if is_deduplicated(conn) else 'tiles'
+
+@contextmanager
+def transaction(conn):
+    """One explicit transaction; sqlite3 would otherwise commit each DDL statement on its own"""
+    isolation_level = conn.isolation_level
+    conn.commit()
+    conn.isolation_level = None
+    conn.execute('BEGIN')
+    try:
+        yield
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+
+def deduplicate_tiles(conn):
+    """Convert a database with a flat tiles table to the deduplicated layout in place, atomically"""
+    conn.create_function('tile_id', 1, tile_id)
+    with transaction(conn):
+        conn.execute('ALTER TABLE tiles RENAME TO flat_tiles')
+        conn.execute('DROP INDEX IF EXISTS tile_index')
+        create_tiles_schema(conn, deduplicate=True)
+        conn.execute('INSERT OR IGNORE INTO images SELECT tile_id(tile_data), tile_data FROM flat_tiles')
+        conn.execute('''
+            INSERT OR REPLACE INTO map
+            SELECT zoom_level, tile_column, tile_row, tile_id(tile_data) FROM flat_tiles
+        ''')
+        conn.execute('DROP TABLE flat_tiles')
+
+def recover_deduplication(conn):
+    """Finish a conversion that an older version left half done; True if there was one
+
+    That version committed each step separately, so a crash could leave every
+    tile in flat_tiles behind an empty tiles view. Tiles written to map since
+    then are kept.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='flat_tiles'").fetchone():
+        return False
+    conn.create_function('tile_id', 1, tile_id)
+    with transaction(conn):
+        conn.execute('DROP INDEX IF EXISTS tile_index')
+        create_tiles_schema(conn, deduplicate=True)
+        conn.execute('INSERT OR IGNORE INTO images SELECT tile_id(tile_data), tile_data FROM flat_tiles')
+        conn.execute('''
+            INSERT OR IGNORE INTO map
+            SELECT zoom_level, tile_column, tile_row, tile_id(tile_data) FROM flat_tiles
+        ''')
+        conn.execute('DROP TABLE flat_tiles')
+    return True
+
+class MBTilesWriter:
+    """Single writer thread for one MBTiles file
+
+    Download workers hand finished tiles to write(), which only puts them on a
+    bounded queue. The writer thread inserts them with executemany and commits
+    a transaction every batch_size tiles or batch_seconds, whichever comes first,
+    so nobody waits on a disk sync per tile. Databases with the deduplicated
+    layout get each distinct image written once. The database runs in WAL mode while
+    writing; close() drains the queue, runs ANALYZE and VACUUM, and switches the
+    file back to a rollback journal so it can be copied to a device as one file.
+    """
+
+    def __init__(self, filepath, batch_size=1000, batch_seconds=5.0, queue_size=5000):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.error = None
+
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+        self.deduplicated = is_deduplicated(self.conn)
+
+        self.thread = threading.Thread(target=self.run, name='mbtiles-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, rows):
+        """Queue (zoom_level, tile_column, tile_row, tile_data) rows; blocks while the queue is full"""
+        while True:
+            if self.error:
+                raise self.error
+            try:
+                self.queue.put(rows, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def insert(self, rows):
+        if not self.deduplicated:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO tiles
+                (zoom_level, tile_column, tile_row, tile_data)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+            return
+
+        images = {}
+        map_rows = []
+        for zoom, column, row, tile_data in rows:
+            key = tile_id(tile_data)
+            images[key] = tile_data
+            map_rows.append((zoom, column, row, key))
+        self.conn.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                              images.items())
+        self.conn.executemany('''
+            INSERT OR REPLACE INTO map
+            (zoom_level, tile_column, tile_row, tile_id)
+            VALUES (?, ?, ?, ?)
+        ''', map_rows)
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.batch_seconds
+        done = False
+        while not done:
+            try:
+                rows = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if rows is None:
+                    done = True
+                else:
+                    batch.extend(rows)
+            except queue.Empty:
+                pass
+
+            if batch and (done or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                try:
+                    with self.conn:
+                        self.insert(batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    self.error = e
+                    print(f"Error writing tiles to {self.filepath}: {e}")
+                    return
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.batch_seconds
+
+    def close(self, optimize=True):
+        """Flush all queued tiles, optionally ANALYZE and VACUUM, and close the database
+
+        Other connections to the file must be closed first.
+        """
+        if not self.error:
+            self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            self.conn.close()
+            raise self.error
+
+        if self.deduplicated:
+            # Images of tiles that were downloaded again with different content
+            with self.conn:
+                self.conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+        if optimize:
+            print(f"Optimizing {self.filepath}...")
+            self.conn.execute('ANALYZE')
+            self.conn.execute('PRAGMA journal_mode=DELETE')
+            self.conn.execute('VACUUM')
+        else:
+            self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.close()
+        return self.written
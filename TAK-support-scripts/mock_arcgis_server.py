@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the CUZK ArcGIS REST services, for benchmarks and offline testing
+
+Point the tile server (CUZK_BASE_URL) or the downloaders (--base-url) at
+http://localhost:8090/arcgis/rest/services to use it.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import numpy as np
+import mercantile
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from PIL import Image
+
+DEFAULT_PORT = 8090
+BASE_PATH = '/arcgis/rest/services'
+MAX_IMAGE_SIZE = 4096  # ArcGIS refuses larger exports too
+
+def pixel_centres(query, width, height):
+    """Web Mercator x of the pixel columns (1 x width) and y of the rows (height x 1) of an export"""
+    west, south, east, north = (float(v) for v in query['bbox'].split(','))
+    if query.get('bboxSR') == '4326':
+        west, north = mercantile.xy(west, north)
+        east, south = mercantile.xy(east, south)
+    xs = west + (np.arange(width, dtype=np.float64) + 0.5) * (east - west) / width
+    ys = north - (np.arange(height, dtype=np.float64) + 0.5) * (north - south) / height
+    return xs[np.newaxis, :], ys[:, np.newaxis]
+
+def synthetic_map(x, y):
+    """RGBA map image as a function of position only
+
+    Smooth colour fields, a 1 km grid and sparse speckle (so tiles compress
+    to roughly the size of real topographic tiles), all derived from the
+    pixel's position: a metatile sliced into tiles matches the same tiles
+    exported one by one. A part of the area is transparent, like a sparse
+    overlay, which gives blank tiles to deduplicate.
+    """
+    rgba = np.empty((y.shape[0], x.shape[1], 4), dtype=np.uint8)
+    rgba[..., 0] = 170 + 60 * np.sin(x / 3000.0) * np.cos(y / 2300.0)
+    rgba[..., 1] = 190 + 50 * np.sin(y / 1700.0)
+    rgba[..., 2] = 150 + 70 * np.cos(x / 2100.0)
+    rgba[..., 3] = 255
+    grid = (np.abs(x % 1000 - 500) > 480) | (np.abs(y % 1000 - 500) > 480)
+    rgba[grid, :3] = 90
+    speckle = np.sin(np.round(x) * 12.9898 + np.round(y) * 78.233)
+    speckle *= 43758.5453
+    rgba[np.abs(speckle) % 1 > 0.97, :3] = 60
+    rgba[np.sin(x / 50000.0) + np.cos(y / 40000.0) < -0.8] = 0
+    return Image.fromarray(rgba, mode='RGBA')
+
+def synthetic_elevation(x, y):
+    """float32 terrain in metres, between about 200 and 800"""
+    elevation = (450 + 200 * np.sin(x / 9000.0) * np.cos(y / 7000.0)
+                 + 40 * np.sin(x / 800.0 + np.cos(y / 1100.0)))
+    return Image.fromarray(elevation.astype(np.float32), mode='F')
+
+class MockArcGISServer:
+    """Threaded HTTP server answering MapServer/export and ImageServer/exportImage
+
+    Every request waits latency_ms plus an exponentially distributed extra
+    delay with mean jitter_ms, so there is a long tail as with the real
+    service. A fraction error_rate of requests fails with 503. /stats returns
+    request counters as JSON.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, latency_ms=50, jitter_ms=30, error_rate=0.0, seed=None, host='127.0.0.1'):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'export': 0, 'exportImage': 0, 'errors': 0, 'bytes': 0}
+        self.httpd = ThreadingHTTPServer((host, port), MockArcGISHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{BASE_PATH}"
+
+    def start(self):
+        """Serve from a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='mock-arcgis', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def delay_and_fail(self):
+        """Sleep for one simulated response time; True if this request should fail"""
+        with self.lock:
+            delay = self.latency + (self.random.expovariate(1 / self.jitter) if self.jitter else 0)
+            fail = self.random.random() < self.error_rate
+        time.sleep(delay)
+        return fail
+
+class MockArcGISHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real service
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            self.send(200, json.dumps(mock.snapshot()).encode(), 'application/json')
+            return
+
+        if not url.path.startswith(BASE_PATH + '/'):
+            self.send(404, b'Not found', 'text/plain')
+            return
+        if url.path.endswith('/MapServer/export'):
+            kind = 'export'
+        elif url.path.endswith('/ImageServer/exportImage'):
+            kind = 'exportImage'
+        else:
+            self.send(404, b'Not found', 'text/plain')
+            return
+
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            width, height = (int(v) for v in query.get('size', '256,256').split(','))
+            if not (0 < width <= MAX_IMAGE_SIZE and 0 < height <= MAX_IMAGE_SIZE):
+                raise ValueError(f"size {width}x{height}")
+            x, y = pixel_centres(query, width, height)
+        except (KeyError, ValueError) as e:
+            self.send(400, f"Invalid request: {e}".encode(), 'text/plain')
+            return
+
+        mock.count(kind)
+        if mock.delay_and_fail():
+            mock.count('errors')
+            self.send(503, b'<html><body>Service Unavailable</body></html>', 'text/html')
+            return
+
+        output = BytesIO()
+        if kind == 'export':
+            synthetic_map(x, y).save(output, format='PNG', compress_level=1)
+            content_type = 'image/png'
+        else:
+            synthetic_elevation(x, y).save(output, format='TIFF')
+            content_type = 'image/tiff'
+        body = output.getvalue()
+        mock.count('bytes', len(body))
+        self.send(200, body, content_type)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic CUZK ArcGIS exports for benchmarks")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency-ms', type=float, default=50,
+                        help="Fixed part of every response time (default: %(default)s)")
+    parser.add_argument('--jitter-ms', type=float, default=30,
+                        help="Mean of the random extra delay (default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with 503 (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockArcGISServer(args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.seed, args.host)
+    print(f"Mock ArcGIS server at {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"Served: {server.snapshot()}")
+
+if __name__ == "__main__":
+    main()
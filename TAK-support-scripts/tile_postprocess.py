@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Parallel tile re-encoding between download and MBTiles write
+"""
+
+import os
+import threading
+from functools import partial
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# Tile formats: how each tile is re-encoded, and the MBTiles format metadata it needs
+TILE_FORMATS = {
+    'png': 'png',           # as returned by CUZK
+    'png-optimize': 'png',  # lossless recompression
+    'png8': 'png',          # 256-colour palette, keeps transparency
+    'jpeg': 'jpg',          # no transparency; transparent areas become white
+    'webp': 'webp',
+}
+
+# What 'auto' picks per ArcGIS service: palette PNG for maps, JPEG for aerial imagery
+DEFAULT_TILE_FORMATS = {
+    'ZABAGED_POLOHOPIS': 'png8',
+    'ZABAGED_VRSTEVNICE': 'png8',
+    'ZMVM/zmvm': 'png8',
+    'ortofoto/ortofoto': 'jpeg',
+}
+
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+def resolve_tile_format(tile_format, service):
+    """Return the tile format to use for a service; 'auto' picks from DEFAULT_TILE_FORMATS"""
+    if tile_format == 'auto':
+        return DEFAULT_TILE_FORMATS.get(service, 'png-optimize')
+    if tile_format not in TILE_FORMATS:
+        raise ValueError(f"Unknown tile format {tile_format}; use one of {', '.join(TILE_FORMATS)} or auto")
+    return tile_format
+
+def encode_tile(tile_format, tile_data):
+    """Re-encode one tile image in the given tile format"""
+    if tile_format == 'png':
+        return tile_data
+
+    img = Image.open(BytesIO(tile_data))
+    output = BytesIO()
+    if tile_format == 'png-optimize':
+        img.save(output, format='PNG', optimize=True)
+    elif tile_format == 'png8':
+        if img.mode != 'P':
+            img = img.convert('RGBA').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        img.save(output, format='PNG', optimize=True)
+    elif tile_format == 'jpeg':
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        background.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    elif tile_format == 'webp':
+        img.save(output, format='WEBP', quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+def encode_tiles(tile_format, rows):
+    """Re-encode the tile_data of (zoom_level, tile_column, tile_row, tile_data) rows"""
+    return [(z, x, y, encode_tile(tile_format, tile_data)) for z, x, y, tile_data in rows]
+
+class TilePostProcessor:
+    """Re-encode downloaded tiles in a process pool and pass them on
+
+    submit() hands a batch of rows to a worker process and returns at once,
+    so the download threads keep the network busy while every core encodes.
+    At most max_pending batches wait for a worker; submit() blocks beyond
+    that. Finished batches go to the callback, typically MBTilesWriter.write,
+    from the pool's result thread. encoder replaces the re-encoding with any
+    picklable function from a list of rows to a list of rows (for example
+    hillshade rendering); tile_format is then only a label.
+    """
+
+    def __init__(self, tile_format, workers=None, max_pending=None, encoder=None):
+        self.tile_format = tile_format
+        self.encoder = encoder or partial(encode_tiles, tile_format)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending = threading.BoundedSemaphore(max_pending or self.workers * 4)
+        self.lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failed = 0
+        self.error = None
+
+    def submit(self, rows, callback):
+        if self.error:
+            raise self.error
+        self.pending.acquire()
+        size = sum(len(row[3]) for row in rows)
+        future = self.pool.submit(self.encoder, rows)
+
+        def done(future):
+            try:
+                encoded = future.result()
+            except Exception as e:
+                # A tile that can't be decoded is left out; resume downloads it again
+                print(f"Error processing {len(rows)} tiles ({self.tile_format}): {e}")
+                with self.lock:
+                    self.failed += len(rows)
+                return
+            finally:
+                self.pending.release()
+            with self.lock:
+                self.bytes_in += size
+                self.bytes_out += sum(len(row[3]) for row in encoded)
+            try:
+                callback(encoded)
+            except Exception as e:
+                self.error = e
+
+        future.add_done_callback(done)
+
+    def close(self):
+        """Wait for all submitted tiles to be encoded and handed to the callback"""
+        self.pool.shutdown(wait=True)
+        if self.error:
+            raise self.error
+
+    def summary(self):
+        ratio = self.bytes_out / self.bytes_in * 100 if self.bytes_in else 100
+        return (f"{self.tile_format}: {self.bytes_in / 1e6:.1f} MB -> {self.bytes_out / 1e6:.1f} MB "
+                f"({ratio:.0f}% of original) on {self.workers} processes, {self.failed} tiles failed")
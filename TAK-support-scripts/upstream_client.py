@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Adaptive HTTP client for bulk downloads from CUZK, shared by the downloaders
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# ArcGIS REST root; CUZK_BASE_URL points the downloaders elsewhere, e.g. at mock_arcgis_server.py
+CUZK_BASE_URL = os.environ.get('CUZK_BASE_URL', "https://ags.cuzk.gov.cz/arcgis/rest/services")
+
+# Responses that mean "try again later" rather than "this tile does not exist"
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+class UpstreamClient:
+    """requests.Session wrapper with AIMD concurrency control and retries
+
+    At most `limit` requests run at once, shared by all worker threads. Each
+    fast success raises the limit by 1/limit (about +1 per round of requests).
+    A 429, 5xx, timeout or response slower than latency_target halves it, at
+    most once per cooldown. Transient failures are retried with jittered
+    exponential backoff, honouring Retry-After. Callers can run up to
+    max_concurrency worker threads and let the client find the rate CUZK
+    tolerates.
+    """
+
+    def __init__(self, user_agent, initial_concurrency=4, min_concurrency=1, max_concurrency=16,
+                 latency_target=10.0, max_retries=4, backoff_base=1.0, backoff_max=60.0, cooldown=5.0):
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': user_agent})
+        adapter = HTTPAdapter(pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cooldown = cooldown
+        self.active = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'throttled': 0}
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+            self.stats['requests'] += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def increase(self):
+        with self.condition:
+            if self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                self.condition.notify_all()
+
+    def decrease(self):
+        with self.condition:
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            self.stats['throttled'] += 1
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.backoff_max, retry_after)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(self, url, timeout=60, what='tile'):
+        """Return the response body for a 200, or None after a permanent or repeated failure"""
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.count('retries')
+
+            retry_after = None
+            self.acquire()
+            started = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=timeout)
+            except requests.RequestException as e:
+                self.release()
+                self.decrease()
+                error = str(e)
+            else:
+                self.release()
+                if response.status_code == 200:
+                    if time.monotonic() - started > self.latency_target:
+                        self.decrease()
+                    else:
+                        self.increase()
+                    return response.content
+                error = f"HTTP {response.status_code}"
+                if response.status_code not in TRANSIENT_STATUS:
+                    print(f"Failed to download {what}: {error}")
+                    self.count('failures')
+                    return None
+                self.decrease()
+                try:
+                    retry_after = float(response.headers.get('Retry-After', ''))
+                except ValueError:
+                    pass
+
+            if attempt < self.max_retries:
+                time.sleep(self.backoff(attempt, retry_after))
+
+        print(f"Error downloading {what} after {self.max_retries + 1} attempts: {error}")
+        self.count('failures')
+        return None
+
+    def count(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def summary(self):
+        return (f"{self.stats['requests']} requests, {self.stats['retries']} retries, "
+                f"{self.stats['failures']} failed, throttled {self.stats['throttled']} times, "
+                f"final concurrency {int(self.limit)}")
+
+class FailedJobs:
+    """Download jobs that still failed after all retries, kept in a JSON file
+
+    Jobs are JSON-friendly lists. A run re-queues what load() returns from the
+    previous run first, then retries what take() returns once at the end, and
+    save() persists whatever still fails for the next run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs.append(job)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return json.load(f)
+
+    def take(self):
+        """Return the jobs that failed so far and start a new list"""
+        with self.lock:
+            jobs, self.jobs = self.jobs, []
+        return jobs
+
+    def save(self):
+        with self.lock:
+            jobs = list(self.jobs)
+        if jobs:
+            with open(self.path, 'w') as f:
+                json.dump(jobs, f)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        return len(jobs)